@@ -272,7 +272,23 @@ ConfigDictTemplate = [
             {
                 "option": "whitelist_auth_weigth",
                 "default": "-5"
-            }
+            },
+            {
+                "option": "worker_count",
+                "default": "auto",
+            },
+            {
+                "option": "proxy_max_conn",
+                "default": "auto",
+            },
+            {
+                "option": "redis_maxmemory",
+                "default": "auto",
+            },
+            {
+                "option": "redis_maxmemory_policy",
+                "default": "volatile-lru",
+            },
         ],
     },
     {
@@ -288,7 +304,7 @@ ConfigDictTemplate = [
             },
             {
                 "option": "max_servers",
-                "default": "2",
+                "default": "auto",
             },
             {
                 "option": "dbname",
@@ -315,6 +331,26 @@ ConfigDictTemplate = [
                 "option": "user",
                 "default": "clamav",
             },
+            {
+                "option": "max_threads",
+                "default": "auto",
+            },
+            {
+                "option": "max_file_size",
+                "default": "auto",
+            },
+            {
+                "option": "max_scan_size",
+                "default": "auto",
+            },
+            {
+                "option": "database_reload",
+                "default": "auto",
+            },
+            {
+                "option": "servers",
+                "default": "",
+            },
         ]
     },
     {
@@ -360,6 +396,34 @@ ConfigDictTemplate = [
                 "option": "oauth2_client_secret",
                 "default": make_client_secret
             },
+            {
+                "option": "auth_cache_size",
+                "default": "auto",
+            },
+            {
+                "option": "auth_cache_ttl",
+                "default": "15 mins",
+            },
+            {
+                "option": "auth_cache_negative_ttl",
+                "default": "2 mins",
+            },
+            {
+                "option": "login_process_min_avail",
+                "default": "auto",
+            },
+            {
+                "option": "vsz_limit",
+                "default": "auto",
+            },
+            {
+                "option": "mail_max_userip_connections",
+                "default": "20",
+            },
+            {
+                "option": "default_client_limit",
+                "default": "auto",
+            },
         ]
     },
     {
@@ -406,7 +470,11 @@ ConfigDictTemplate = [
             {
                 "option": "dhe_group",
                 "default": "4096"
-            }
+            },
+            {
+                "option": "profile",
+                "default": "auto",
+            },
         ]
     },
     {
@@ -463,7 +531,19 @@ ConfigDictTemplate = [
             },
             {
                 "option": "nb_processes",
-                "default": "4",
+                "default": "auto",
+            },
+            {
+                "option": "nb_threads",
+                "default": "auto",
+            },
+            {
+                "option": "expected_concurrency",
+                "default": "0",
+            },
+            {
+                "option": "harakiri",
+                "default": "auto",
             },
         ]
     },
@@ -533,13 +613,92 @@ ConfigDictTemplate = [
 
         ]
     },
+    {
+        "name": "pgbouncer",
+        "values": [
+            {
+                "option": "enabled",
+                "default": "false",
+            },
+            {
+                "option": "config_dir",
+                "default": "/etc/pgbouncer",
+            },
+            {
+                "option": "port",
+                "default": "6432",
+            },
+            {
+                "option": "pool_mode",
+                "default": "transaction",
+            },
+            {
+                "option": "default_pool_size",
+                "default": "auto",
+            },
+            {
+                "option": "max_client_conn",
+                "default": "auto",
+            },
+        ]
+    },
     {
         "name": "backup",
         "values": [
             {
                 "option": "default_path",
                 "default": DEFAULT_BACKUP_DIRECTORY
-            }
+            },
+            {
+                "option": "incremental_mails",
+                "default": "false"
+            },
+            {
+                "option": "copy_workers",
+                "default": "4"
+            },
+            {
+                "option": "dump_compression",
+                "default": "none",
+                "values": ["none", "gzip", "zstd"]
+            },
+            {
+                "option": "dump_jobs",
+                "default": "1"
+            },
+            {
+                "option": "pg_directory_format",
+                "default": "false"
+            },
+        ]
+    },
+    {
+        "name": "cache",
+        "values": [
+            {
+                "option": "wheelhouse",
+                "default": "false",
+            },
+            {
+                "option": "wheelhouse_dir",
+                "default": "/var/cache/modoboa-installer/wheels",
+            },
+            {
+                "option": "venv_archive",
+                "default": "false",
+            },
+            {
+                "option": "venv_archive_dir",
+                "default": "/var/cache/modoboa-installer/venvs",
+            },
+            {
+                "option": "packages",
+                "default": "false",
+            },
+            {
+                "option": "packages_dir",
+                "default": "/var/cache/modoboa-installer/packages",
+            },
         ]
     }
 ]
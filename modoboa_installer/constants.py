@@ -1 +1,10 @@
 DEFAULT_BACKUP_DIRECTORY = "./modoboa_backup/"
+
+# Manifest written next to the mails/ directory of a backup
+MAIL_BACKUP_MANIFEST = "mails.manifest.json"
+
+# Trace report written by --profile when no path is given
+DEFAULT_PROFILE_REPORT = "./modoboa-installer-profile.json"
+
+# Touched to make uWSGI reload Modoboa (relative to Modoboa's home_dir)
+UWSGI_RELOAD_FILE = "uwsgi.reload"
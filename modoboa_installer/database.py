@@ -1,21 +1,72 @@
 """Database related tools."""
 
+import contextlib
+import glob
+import itertools
+import operator
 import os
 import pwd
+import shutil
 import stat
+import threading
 from typing import Optional
 
 from . import package
 from . import system
+from . import tuning
 from . import utils
 
 
+# Compression and decompression commands, file suffix
+DUMP_COMPRESSORS = {
+    "gzip": ("gzip -c", "gzip -dc", ".gz"),
+    "zstd": ("zstd -q -c", "zstd -q -dc", ".zst"),
+}
+# Suffix of directory format (pg_dump -Fd) dumps
+DUMP_DIRECTORY_SUFFIX = ".dump"
+# Delimiter of the here-document used to feed queries to clients
+SQL_HEREDOC_DELIMITER = "MODOBOA_INSTALLER_SQL"
+# Address PgBouncer listens on
+POOLER_HOST = "127.0.0.1"
+# Repository providing newer PostgreSQL versions on CentOS 7
+PGDG_REPO_PACKAGE = "pgdg-redhat-repo"
+PGDG_REPO_URL = (
+    "https://download.postgresql.org/pub/repos/yum/"
+    "reporpms/EL-7-x86_64/pgdg-redhat-repo-latest.noarch.rpm"
+)
+
+
+def find_dump(directory, name):
+    """Look for a dump of database name in any supported format."""
+    candidates = ["{}.sql".format(name)]
+    candidates += [
+        "{}.sql{}".format(name, compressor[2])
+        for compressor in DUMP_COMPRESSORS.values()
+    ]
+    candidates.append("{}{}".format(name, DUMP_DIRECTORY_SUFFIX))
+    for candidate in candidates:
+        path = os.path.join(directory, candidate)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def get_decompress_command(path):
+    """Return the command to decompress a dump, None if not compressed."""
+    for compressor in DUMP_COMPRESSORS.values():
+        if path.endswith(compressor[2]):
+            return compressor[1]
+    return None
+
+
 class Database:
     """Common database backend."""
 
     default_port: Optional[int] = None
     packages: Optional[dict[str, list[str]]] = None
     service: Optional[str] = None
+    # Name of the server settings file generated from host resources
+    tuning_config_name: Optional[str] = None
 
     def __init__(self, config):
         """Install if necessary."""
@@ -26,14 +77,113 @@ class Database:
             "database", "port", fallback=self.default_port)
         self.dbuser = config.get(engine, "user")
         self.dbpassword = config.get(engine, "password")
-        if self.config.getboolean("database", "install"):
-            self.install_package()
+        # Queued queries, per thread since installers can run concurrently
+        self._local = threading.local()
+
+    def get_packages(self):
+        """Return the list of packages to install."""
+        return list(self.packages[package.backend.FORMAT])
+
+    def prepare_packages(self):
+        """Configure repositories if needed."""
+        pass
 
     def install_package(self):
         """Install database package if required."""
-        package.backend.install_many(self.packages[package.backend.FORMAT])
+        self.prepare_packages()
+        package.backend.install_many(self.get_packages())
         system.enable_and_start_service(self.service)
 
+    def get_tuning_content(self):
+        """Return server settings sized from host resources."""
+        raise NotImplementedError
+
+    def tune(self, config_dir):
+        """Write server settings sized from host resources.
+
+        :return: True if settings have changed
+        """
+        if config_dir is None:
+            utils.error(
+                "Database server configuration directory not found, "
+                "settings left unchanged")
+            return False
+        return utils.write_config_file(
+            os.path.join(config_dir, self.tuning_config_name),
+            self.get_tuning_content())
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Queue queries instead of running them one by one.
+
+        Queued queries are sent when the outermost batch ends (or before
+        any operation depending on them, like loading a SQL file), using
+        one client session per set of connection parameters. Statements
+        are not wrapped in a transaction so a failing one (an existing
+        user for example) does not prevent the next ones from running.
+        """
+        if getattr(self._local, "queries", None) is not None:
+            yield
+            return
+        self._local.queries = []
+        try:
+            yield
+            self.flush()
+        finally:
+            self._local.queries = None
+
+    def flush(self):
+        """Run queued queries."""
+        queries = getattr(self._local, "queries", None)
+        if not queries:
+            return
+        self._local.queries = []
+        groups = itertools.groupby(queries, key=operator.itemgetter(0))
+        for params, group in groups:
+            self._run_queries([query for _, query in group], *params)
+
+    def _exec_query(self, query, dbname=None, dbuser=None, dbpassword=None):
+        """Exec a query, or queue it if a batch is in progress."""
+        queries = getattr(self._local, "queries", None)
+        params = (dbname, dbuser, dbpassword)
+        if queries is None:
+            self._run_queries([query], *params)
+        else:
+            queries.append((params, query))
+
+    def _run_queries(self, queries, dbname=None, dbuser=None,
+                     dbpassword=None):
+        """Run queries using a single client session."""
+        raise NotImplementedError
+
+    def _feed_queries(self, cmd, queries, **kwargs):
+        """Send queries to the standard input of a client command."""
+        statements = []
+        for query in queries:
+            query = query.rstrip()
+            if not query.endswith((";", "\\gexec")):
+                query += ";"
+            statements.append(query)
+        return utils.exec_cmd(
+            "{} <<'{}'\n{}\n{}".format(
+                cmd, SQL_HEREDOC_DELIMITER, "\n".join(statements),
+                SQL_HEREDOC_DELIMITER),
+            **kwargs)
+
+    @property
+    def dump_jobs(self):
+        """Number of databases (or tables) dumped concurrently."""
+        return utils.get_dump_jobs(self.config)
+
+    def get_compressor(self):
+        """Return the compressor to use for dumps, None for plain SQL."""
+        name = self.config.get("backup", "dump_compression", fallback="none")
+        if name not in DUMP_COMPRESSORS:
+            return None
+        if shutil.which(name) is None:
+            package.backend.install(name)
+        return DUMP_COMPRESSORS[name]
+
 
 class PostgreSQL(Database):
     """Postgres."""
@@ -44,71 +194,139 @@ class PostgreSQL(Database):
         "rpm": ["postgresql-server", "postgresql-devel"]
     }
     service = "postgresql"
+    tuning_config_name = "modoboa-installer.conf"
+    # Major version of the installed server, None if unknown
+    server_version: Optional[int] = None
 
-    def __init__(self, config):
-        super().__init__(config)
-        self._pgpass_done = False
+    # .pgpass entries shared by all instances since dumps can run
+    # concurrently
+    _pgpass_entries = {}
+    _pgpass_lock = threading.Lock()
+
+    def get_packages(self):
+        """Use a newer version of postgres on CentOS 7."""
+        name, version = utils.dist_info()
+        if "CentOS" in name and version.startswith("7"):
+            return ["postgresql10-server", "postgresql10-devel"]
+        return super().get_packages()
+
+    def prepare_packages(self):
+        """Add the PostgreSQL repository on CentOS 7."""
+        name, version = utils.dist_info()
+        if "CentOS" not in name or not version.startswith("7"):
+            return
+        if package.backend.get_installed_version(PGDG_REPO_PACKAGE):
+            return
+        package.backend.install(PGDG_REPO_URL)
 
     def install_package(self):
         """Install database if required."""
         name, version = utils.dist_info()
         if "CentOS" in name:
+            self.prepare_packages()
             if version.startswith("7"):
                 # Install newer version of postgres in this case
-                package.backend.install(
-                    "https://download.postgresql.org/pub/repos/yum/"
-                    "reporpms/EL-7-x86_64/pgdg-redhat-repo-latest.noarch.rpm"
-                )
-                self.packages["rpm"] = [
-                    "postgresql10-server", "postgresql10-devel"]
                 self.service = "postgresql-10"
                 initdb_cmd = "/usr/pgsql-10/bin/postgresql-10-setup initdb"
                 cfgfile = "/var/lib/pgsql/10/data/pg_hba.conf"
             else:
                 initdb_cmd = "postgresql-setup initdb"
                 cfgfile = "/var/lib/pgsql/data/pg_hba.conf"
-            package.backend.install_many(self.packages[package.backend.FORMAT])
+            package.backend.install_many(self.get_packages())
             utils.exec_cmd(initdb_cmd)
             pattern = "s/^host(.+)ident$/host$1md5/"
             utils.exec_cmd("perl -pi -e '{}' {}".format(pattern, cfgfile))
+            data_dir = os.path.dirname(cfgfile)
+            self.server_version = self._read_server_version(data_dir)
+            config_dir = self._include_config_dir(data_dir)
         else:
-            package.backend.install_many(self.packages[package.backend.FORMAT])
-        system.enable_and_start_service(self.service)
+            package.backend.install_many(self.get_packages())
+            config_dir = self._get_debian_config_dir()
+        changed = self.tune(config_dir)
+        system.enable_and_start_service(self.service, restart=changed)
+
+    def _get_debian_config_dir(self):
+        """Return the conf.d directory of the most recent cluster."""
+        clusters = glob.glob("/etc/postgresql/*/main")
+        if not clusters:
+            return None
+        clusters.sort(
+            key=lambda path: utils.convert_version_to_int(
+                path.split(os.sep)[3]))
+        self.server_version = self._parse_major_version(
+            clusters[-1].split(os.sep)[3])
+        config_dir = os.path.join(clusters[-1], "conf.d")
+        os.makedirs(config_dir, exist_ok=True)
+        return config_dir
+
+    def _parse_major_version(self, version):
+        """Return the major version of a server version string."""
+        try:
+            return int(version.strip().split(".")[0])
+        except ValueError:
+            return None
+
+    def _read_server_version(self, data_dir):
+        """Return the major version of the cluster in data_dir."""
+        try:
+            with open(os.path.join(data_dir, "PG_VERSION")) as fp:
+                return self._parse_major_version(fp.read())
+        except OSError:
+            return None
+
+    def _include_config_dir(self, data_dir):
+        """Make postgresql.conf include a conf.d directory."""
+        config_dir = os.path.join(data_dir, "conf.d")
+        os.makedirs(config_dir, exist_ok=True)
+        cfgfile = os.path.join(data_dir, "postgresql.conf")
+        with open(cfgfile) as fp:
+            content = fp.read()
+        if "\ninclude_dir = 'conf.d'" not in content:
+            with open(cfgfile, "a") as fp:
+                fp.write("\ninclude_dir = 'conf.d'\n")
+        return config_dir
+
+    def get_tuning_content(self):
+        """Return server settings sized from host resources."""
+        settings = tuning.get_postgres_settings(
+            self.config, version=self.server_version)
+        return "".join(
+            "{} = {}\n".format(name, value)
+            for name, value in settings.items()
+        )
 
-    def _exec_query(self, query, dbname=None, dbuser=None, dbpassword=None):
-        """Exec a postgresql query."""
-        cmd = "psql"
+    def _run_queries(self, queries, dbname=None, dbuser=None,
+                     dbpassword=None):
+        """Run postgresql queries through one psql session."""
+        cmd = "psql -q"
         if dbname:
             cmd += " -d {}".format(dbname)
             if dbuser:
                 self._setup_pgpass(dbname, dbuser, dbpassword)
                 cmd += " -h {} -p {} -U {} -w".format(
                     self.dbhost, self.dbport, dbuser)
-        query = query.replace("'", "'\"'\"'")
-        cmd = "{} -c '{}' ".format(cmd, query)
-        utils.exec_cmd(cmd, sudo_user=self.dbuser)
+        self._feed_queries(cmd, queries, sudo_user=self.dbuser)
 
     def create_user(self, name, password):
         """Create a user."""
-        query = "SELECT 1 FROM pg_roles WHERE rolname='{}'".format(name)
-        code, output = utils.exec_cmd(
-            """psql -tAc "{}" | grep -q 1""".format(query),
-            sudo_user=self.dbuser)
-        if not code:
-            return
-        query = "CREATE USER {} PASSWORD '{}'".format(name, password)
+        query = (
+            "DO $$ BEGIN "
+            "IF NOT EXISTS (SELECT FROM pg_roles WHERE rolname = '{0}') THEN "
+            "CREATE USER {0} PASSWORD '{1}'; "
+            "END IF; END $$".format(name, password)
+        )
         self._exec_query(query)
 
     def create_database(self, name, owner):
         """Create a database."""
-        code, output = utils.exec_cmd(
-            "psql -lqt | cut -d \\| -f 1 | grep -w {} | wc -l"
-            .format(name), sudo_user=self.dbuser)
-        if code:
-            return
-        utils.exec_cmd(
-            "createdb {} -O {}".format(name, owner),
-            sudo_user=self.dbuser)
+        # CREATE DATABASE can't be run from a DO block
+        query = (
+            "SELECT 'CREATE DATABASE {0} OWNER {1}' "
+            "WHERE NOT EXISTS "
+            "(SELECT FROM pg_database WHERE datname = '{0}')\\gexec"
+            .format(name, owner)
+        )
+        self._exec_query(query)
 
     def grant_access(self, dbname, user):
         """Grant access to dbname."""
@@ -121,38 +339,90 @@ class PostgreSQL(Database):
             right.upper(), table, user)
         self._exec_query(query, dbname=dbname)
 
+    def _get_pgpass_path(self):
+        """Return the path of the .pgpass file used by psql."""
+        return os.path.join(pwd.getpwnam(self.dbuser)[5], ".pgpass")
+
     def _setup_pgpass(self, dbname, dbuser, dbpasswd):
         """Setup .pgpass file."""
-        if self._pgpass_done:
-            return
         if self.dbhost not in ["localhost", "127.0.0.1"]:
-            self._pgpass_done = True
             return
-        pw = pwd.getpwnam(self.dbuser)
-        target = os.path.join(pw[5], ".pgpass")
-        with open(target, "w") as fp:
-            fp.write("127.0.0.1:*:{}:{}:{}\n".format(
-                dbname, dbname, dbpasswd))
-        mode = stat.S_IRUSR | stat.S_IWUSR
-        os.chmod(target, mode)
-        os.chown(target, pw[2], pw[3])
-        self._pgpass_done = True
+        with self._pgpass_lock:
+            if self._pgpass_entries.get(dbname) == (dbuser, dbpasswd):
+                return
+            self._pgpass_entries[dbname] = (dbuser, dbpasswd)
+            pw = pwd.getpwnam(self.dbuser)
+            target = self._get_pgpass_path()
+            with open(target, "w") as fp:
+                for name, (user, passwd) in self._pgpass_entries.items():
+                    fp.write("127.0.0.1:*:{}:{}:{}\n".format(
+                        name, user, passwd))
+            mode = stat.S_IRUSR | stat.S_IWUSR
+            os.chmod(target, mode)
+            os.chown(target, pw[2], pw[3])
 
     def load_sql_file(self, dbname, dbuser, dbpassword, path):
-        """Load SQL file."""
+        """Load SQL file.
+
+        Compressed dumps and directory format dumps are supported.
+        Those are loaded as root, using the .pgpass file of the
+        postgres user since it can't read backup directories.
+        """
+        self.flush()
         self._setup_pgpass(dbname, dbuser, dbpassword)
+        if os.path.isdir(path):
+            cmd = (
+                "PGPASSFILE={} pg_restore -h {} -p {} -d {} -U {} -w -O "
+                "-j {} {}".format(
+                    self._get_pgpass_path(), self.dbhost, self.dbport,
+                    dbname, dbuser, self.dump_jobs, path)
+            )
+            utils.exec_cmd(cmd)
+            return
+        decompress = get_decompress_command(path)
+        if decompress:
+            cmd = (
+                "{} {} | PGPASSFILE={} psql -h {} -p {} -d {} -U {} -w"
+                .format(decompress, path, self._get_pgpass_path(),
+                        self.dbhost, self.dbport, dbname, dbuser)
+            )
+            utils.exec_cmd(cmd)
+            return
         cmd = "psql -h {} -p {} -d {} -U {} -w < {}".format(
             self.dbhost, self.dbport, dbname, dbuser, path)
         utils.exec_cmd(cmd, sudo_user=self.dbuser)
 
     def dump_database(self, dbname, dbuser, dbpassword, path):
-        """Dump DB to SQL file."""
-        # Reset pgpass since we backup multiple db (different secret set)
-        self._pgpass_done = False
+        """Dump DB to SQL file.
+
+        Depending on the [backup] section, the dump is compressed on
+        the fly or written in directory format using several jobs.
+
+        :return: the path of the dump
+        """
+        self.flush()
         self._setup_pgpass(dbname, dbuser, dbpassword)
-        cmd = "pg_dump -h {} -d {} -U {} -O  -w > {}".format(
-            self.dbhost, dbname, dbuser, path)
-        utils.exec_cmd(cmd, sudo_user=self.dbuser)
+        if self.config.getboolean(
+                "backup", "pg_directory_format", fallback=False):
+            path = os.path.splitext(path)[0] + DUMP_DIRECTORY_SUFFIX
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            cmd = (
+                "PGPASSFILE={} pg_dump -h {} -d {} -U {} -O -w -Fd -j {} "
+                "-f {}".format(
+                    self._get_pgpass_path(), self.dbhost, dbname, dbuser,
+                    self.dump_jobs, path)
+            )
+            utils.exec_cmd(cmd)
+            return path
+        cmd = "pg_dump -h {} -d {} -U {} -O  -w".format(
+            self.dbhost, dbname, dbuser)
+        compressor = self.get_compressor()
+        if compressor:
+            cmd += " | {}".format(compressor[0])
+            path += compressor[2]
+        utils.exec_cmd("{} > {}".format(cmd, path), sudo_user=self.dbuser)
+        return path
 
 
 class MySQL(Database):
@@ -164,29 +434,39 @@ class MySQL(Database):
         "rpm": ["mariadb", "mariadb-devel", "mariadb-server"],
     }
     service = "mariadb"
+    tuning_config_name = "90-modoboa-installer.cnf"
+    # Drop-in directories on Debian and RedHat based systems
+    config_dirs = ["/etc/mysql/mariadb.conf.d", "/etc/my.cnf.d"]
 
-    def _escape(self, query):
-        """Replace special characters."""
-        return query.replace("'", "'\"'\"'")
-
-    def install_package(self):
-        """Preseed package installation."""
+    def get_packages(self):
+        """Add the appropriate client library."""
+        packages = super().get_packages()
         name, version = utils.dist_info()
         name = name.lower()
         if name.startswith("debian"):
             if version.startswith("8"):
-                self.packages["deb"].append("libmysqlclient-dev")
+                packages.append("libmysqlclient-dev")
             elif int(version[:2]) >= 11:
-                self.packages["deb"].append("libmariadb-dev")
+                packages.append("libmariadb-dev")
             else:
-                self.packages["deb"].append("libmariadbclient-dev")
+                packages.append("libmariadbclient-dev")
         elif name == "ubuntu":
             if version.startswith("2"):
                 # Works for Ubuntu 20, 22, and 24.
-                self.packages["deb"].append("libmariadb-dev")
+                packages.append("libmariadb-dev")
             else:
-                self.packages["deb"].append("libmysqlclient-dev")
+                packages.append("libmysqlclient-dev")
+        return packages
+
+    def install_package(self):
+        """Preseed package installation."""
+        name, version = utils.dist_info()
+        name = name.lower()
         super().install_package()
+        config_dir = next(
+            (path for path in self.config_dirs if os.path.isdir(path)), None)
+        if self.tune(config_dir):
+            system.restart_service(self.service)
         queries = []
         if name.startswith("debian"):
             if version.startswith("8"):
@@ -213,22 +493,29 @@ class MySQL(Database):
                 .format(self.dbpassword),
                 "flush privileges"
             ]
-        for query in queries:
-            utils.exec_cmd(
-                "mysql -D mysql -e '{}'".format(self._escape(query)))
+        self._feed_queries("mysql --force -D mysql", queries)
+
+    def get_tuning_content(self):
+        """Return server settings sized from host resources."""
+        settings = tuning.get_mysql_settings(self.config)
+        return "[mysqld]\n" + "".join(
+            "{} = {}\n".format(name, value)
+            for name, value in settings.items()
+        )
 
-    def _exec_query(self, query, dbname=None, dbuser=None, dbpassword=None):
-        """Exec a mysql query."""
+    def _run_queries(self, queries, dbname=None, dbuser=None,
+                     dbpassword=None):
+        """Run mysql queries through one mysql session."""
         if dbuser is None and dbpassword is None:
             dbuser = self.dbuser
             dbpassword = self.dbpassword
-        cmd = "mysql -h {} -P {} -u {}".format(
+        cmd = "mysql --force -h {} -P {} -u {}".format(
             self.dbhost, self.dbport, dbuser)
         if dbpassword:
             cmd += " -p{}".format(dbpassword)
         if dbname:
             cmd += " -D {}".format(dbname)
-        utils.exec_cmd(cmd + """ -e '{}' """.format(self._escape(query)))
+        self._feed_queries(cmd, queries)
 
     def create_user(self, name, password):
         """Create a user."""
@@ -266,17 +553,40 @@ class MySQL(Database):
         self._exec_query(query)
 
     def load_sql_file(self, dbname, dbuser, dbpassword, path):
-        """Load SQL file."""
-        utils.exec_cmd(
-            "mysql -h {} -P {} -u {} -p{} {} < {}".format(
-                self.dbhost, self.dbport, dbuser, dbpassword, dbname, path)
-        )
+        """Load SQL file (compressed or not)."""
+        self.flush()
+        cmd = "mysql -h {} -P {} -u {} -p{} {}".format(
+            self.dbhost, self.dbport, dbuser, dbpassword, dbname)
+        decompress = get_decompress_command(path)
+        if decompress:
+            utils.exec_cmd("{} {} | {}".format(decompress, path, cmd))
+        else:
+            utils.exec_cmd("{} < {}".format(cmd, path))
 
     def dump_database(self, dbname, dbuser, dbpassword, path):
-        """Dump DB to SQL file."""
-        cmd = "mysqldump -h {} -u {} -p{} {} > {}".format(
-            self.dbhost, dbuser, dbpassword, dbname, path)
-        utils.exec_cmd(cmd, sudo_user=self.dbuser)
+        """Dump DB to SQL file, compressed on the fly if required.
+
+        :return: the path of the dump
+        """
+        self.flush()
+        cmd = (
+            "mysqldump --single-transaction --quick -h {} -u {} -p{} {}"
+            .format(self.dbhost, dbuser, dbpassword, dbname)
+        )
+        compressor = self.get_compressor()
+        if compressor:
+            cmd += " | {}".format(compressor[0])
+            path += compressor[2]
+        utils.exec_cmd("{} > {}".format(cmd, path), sudo_user=self.dbuser)
+        return path
+
+
+def is_pooler_enabled(config):
+    """Tell if applications connect to PostgreSQL through PgBouncer."""
+    return (
+        config.get("database", "engine") == "postgres" and
+        config.getboolean("pgbouncer", "enabled", fallback=False)
+    )
 
 
 def get_backend(config):
@@ -1,6 +1,9 @@
 """Package management related tools."""
 
+import os
 import re
+import shutil
+import threading
 
 from os.path import isfile as file_exists
 
@@ -13,6 +16,21 @@ class Package:
     def __init__(self, dist_name):
         """Constructor."""
         self.dist_name = dist_name
+        # Package managers hold an exclusive lock: make sure concurrent
+        # installers never run two transactions at the same time.
+        self.lock = threading.RLock()
+        # Packages successfully installed during this run
+        self.installed_packages = set()
+        # Versions of installed packages, loaded at once when needed
+        self._installed_versions = None
+        # Versions before the first installation of this run
+        self._initial_versions = None
+        # Local repository (see use_local_repository and prefetch)
+        self.local_repository = None
+
+    def get_missing_packages(self, names):
+        """Return packages which were not installed during this run."""
+        return [name for name in names if name not in self.installed_packages]
 
     def preconfigure(self, name, question, qtype, answer):
         """Empty method."""
@@ -24,6 +42,55 @@ class Package:
     def restore_system(self):
         pass
 
+    def use_local_repository(self, path):
+        """Install packages from a repository built by prefetch."""
+        raise NotImplementedError
+
+    def prefetch(self, names, path):
+        """Download packages and their dependencies to a local repository."""
+        raise NotImplementedError
+
+    def get_cached_key(self, name):
+        """Return the path of a repository key cached in local repository."""
+        if not self.local_repository:
+            return None
+        return os.path.join(self.local_repository, "keys", f"{name}.gpg")
+
+    def invalidate_cache(self):
+        """Forget installed package versions (after an installation)."""
+        with self.lock:
+            self._installed_versions = None
+
+    def load_installed_versions(self):
+        """Return a package name -> version mapping of installed packages."""
+        raise NotImplementedError
+
+    def snapshot_versions(self):
+        """Remember installed versions before anything is installed."""
+        with self.lock:
+            if self._initial_versions is None:
+                self._initial_versions = self.load_installed_versions()
+
+    def packages_changed(self, names):
+        """Tell if packages were installed or upgraded during this run."""
+        with self.lock:
+            if self._initial_versions is None:
+                return False
+            # Ignore target releases (pkg/bookworm-backports)
+            names = [name.split("/", 1)[0] for name in names]
+            return any(
+                self._initial_versions.get(name) !=
+                self.get_installed_version(name)
+                for name in names
+            )
+
+    def get_installed_version(self, name):
+        """Get installed package version."""
+        with self.lock:
+            if self._installed_versions is None:
+                self._installed_versions = self.load_installed_versions()
+            return self._installed_versions.get(name)
+
 
 class DEBPackage(Package):
     """DEB based operations."""
@@ -34,13 +101,19 @@ class DEBPackage(Package):
         super().__init__(dist_name)
         self.index_updated = False
         self.policy_file = "/usr/sbin/policy-rc.d"
+        self.preseeds = []
+        self.local_source_file = (
+            "/etc/apt/sources.list.d/modoboa-installer-local.list")
+        self.local_preferences_file = (
+            "/etc/apt/preferences.d/modoboa-installer-local")
 
     def enable_backports(self, codename):
         code, output = utils.exec_cmd(f"grep {codename}-backports /etc/apt/sources.list")
         if code:
-            with open(f"/etc/apt/sources.list.d/backports.list", "w") as fp:
-                fp.write(f"deb http://deb.debian.org/debian {codename}-backports main\n")
-            self.update(force=True)
+            with self.lock:
+                with open(f"/etc/apt/sources.list.d/backports.list", "w") as fp:
+                    fp.write(f"deb http://deb.debian.org/debian {codename}-backports main\n")
+                self.update(force=True)
 
     def prepare_system(self):
         """Make sure services don't start at installation."""
@@ -49,7 +122,43 @@ class DEBPackage(Package):
         utils.exec_cmd("chmod +x {}".format(self.policy_file))
 
     def restore_system(self):
-        utils.exec_cmd("rm -f {}".format(self.policy_file))
+        utils.exec_cmd("rm -f {} {} {}".format(
+            self.policy_file, self.local_source_file,
+            self.local_preferences_file))
+
+    def use_local_repository(self, path):
+        """Add local repository, preferred over mirrors."""
+        with self.lock:
+            self.local_repository = path
+            with open(self.local_source_file, "w") as fp:
+                fp.write(f"deb [trusted=yes] file:{path} ./\n")
+            # Local repositories have no origin
+            with open(self.local_preferences_file, "w") as fp:
+                fp.write('Package: *\nPin: origin ""\nPin-Priority: 600\n')
+            self.index_updated = False
+
+    def prefetch(self, names, path):
+        """Download packages and dependencies, then generate an index."""
+        with self.lock:
+            self.local_repository = path
+            os.makedirs(path, exist_ok=True)
+            self.update()
+            self.install("dpkg-dev")
+            code, output = utils.exec_cmd(
+                "apt-cache depends --recurse --no-recommends --no-suggests "
+                "--no-conflicts --no-breaks --no-replaces --no-enhances "
+                "{} | grep '^\\w' | sort -u".format(" ".join(names)))
+            if code:
+                return code, output
+            names = output.decode().split()
+            code, output = utils.exec_cmd(
+                "apt-get download --quiet {}".format(" ".join(names)),
+                cwd=path, tail=utils.ERROR_OUTPUT_LINES)
+            if code:
+                return code, output
+            return utils.exec_cmd(
+                "dpkg-scanpackages --multiversion . /dev/null > Packages",
+                cwd=path, tail=utils.ERROR_OUTPUT_LINES)
 
     def add_custom_repository(self,
                               name: str,
@@ -58,53 +167,94 @@ class DEBPackage(Package):
                               codename: str,
                               with_source: bool = True):
         key_file = f"/etc/apt/keyrings/{name}.gpg"
-        utils.exec_cmd(
-            f"wget -O - {key_url} | gpg --dearmor | tee {key_file} > /dev/null"
-        )
+        cached_key = self.get_cached_key(name)
+        if cached_key and file_exists(cached_key):
+            shutil.copyfile(cached_key, key_file)
+        else:
+            utils.exec_cmd(
+                f"wget -O - {key_url} | gpg --dearmor | tee {key_file} > /dev/null"
+            )
+            if cached_key:
+                os.makedirs(os.path.dirname(cached_key), exist_ok=True)
+                shutil.copyfile(key_file, cached_key)
         line_types = ["deb"]
         if with_source:
             line_types.append("deb-src")
-        for line_type in line_types:
-            line = (
-                f"{line_type} [arch=amd64 signed-by={key_file}] "
-                f"{url} {codename} main"
-            )
-            target_file = f"/etc/apt/sources.list.d/{name}.list"
-            tee_option = "-a" if file_exists(target_file) else ""
-            utils.exec_cmd(f'echo "{line}" | tee {tee_option} {target_file}')
-        self.index_updated = False
+        with self.lock:
+            for line_type in line_types:
+                line = (
+                    f"{line_type} [arch=amd64 signed-by={key_file}] "
+                    f"{url} {codename} main"
+                )
+                target_file = f"/etc/apt/sources.list.d/{name}.list"
+                tee_option = "-a" if file_exists(target_file) else ""
+                utils.exec_cmd(f'echo "{line}" | tee {tee_option} {target_file}')
+            self.index_updated = False
 
     def update(self, force=False):
         """Update local cache."""
-        if self.index_updated and not force:
-            return
-        utils.exec_cmd("apt-get -o Dpkg::Progress-Fancy=0 update --quiet")
-        self.index_updated = True
+        with self.lock:
+            if self.index_updated and not force:
+                return
+            utils.exec_cmd("apt-get -o Dpkg::Progress-Fancy=0 update --quiet")
+            self.index_updated = True
 
     def preconfigure(self, name, question, qtype, answer):
         """Pre-configure a package before installation."""
         line = "{0} {0}/{1} {2} {3}".format(name, question, qtype, answer)
-        utils.exec_cmd("echo '{}' | debconf-set-selections".format(line))
+        with self.lock:
+            self.preseeds.append(line)
+
+    def apply_preseeds(self):
+        """Send pending preconfiguration answers to debconf at once."""
+        with self.lock:
+            if not self.preseeds:
+                return
+            utils.exec_cmd("printf '%s\\n' {} | debconf-set-selections".format(
+                " ".join("'{}'".format(line) for line in self.preseeds)))
+            self.preseeds = []
 
     def install(self, name):
         """Install a package."""
-        self.update()
-        utils.exec_cmd("apt-get -o Dpkg::Progress-Fancy=0 install --quiet --assume-yes -o DPkg::options::=--force-confold {}".format(name))
+        with self.lock:
+            self.snapshot_versions()
+            self.update()
+            self.apply_preseeds()
+            utils.exec_cmd("apt-get -o Dpkg::Progress-Fancy=0 install --quiet --assume-yes -o DPkg::options::=--force-confold {}".format(name))
+            self.invalidate_cache()
 
     def install_many(self, names):
         """Install many packages."""
-        self.update()
-        return utils.exec_cmd("apt-get -o Dpkg::Progress-Fancy=0 install --quiet --assume-yes -o DPkg::options::=--force-confold {}".format(
-            " ".join(names)))
-
-    def get_installed_version(self, name):
-        """Get installed package version."""
+        with self.lock:
+            names = self.get_missing_packages(names)
+            if not names:
+                return 0, b""
+            self.snapshot_versions()
+            self.update()
+            self.apply_preseeds()
+            code, output = utils.exec_cmd("apt-get -o Dpkg::Progress-Fancy=0 install --quiet --assume-yes -o DPkg::options::=--force-confold {}".format(
+                " ".join(names)), tail=utils.ERROR_OUTPUT_LINES)
+            self.invalidate_cache()
+            if not code:
+                self.installed_packages.update(names)
+            return code, output
+
+    def load_installed_versions(self):
+        """Query the dpkg database once."""
         code, output = utils.exec_cmd(
-            "dpkg -s {} | grep Version".format(name))
-        match = re.match(r"Version: (\d:)?(.+)-\d", output.decode())
-        if match:
-            return match.group(2)
-        return None
+            "dpkg-query -W -f='${db:Status-Abbrev} ${Package} ${Version}\\n'")
+        versions = {}
+        for line in output.decode().splitlines():
+            try:
+                status, name, version = line.split()
+            except ValueError:
+                continue
+            if status[1] != "i" or name in versions:
+                continue
+            match = re.match(r"(\d:)?(.+)-\d", version)
+            if match:
+                versions[name] = match.group(2)
+        return versions
 
 
 class RPMPackage(Package):
@@ -115,25 +265,76 @@ class RPMPackage(Package):
     def __init__(self, dist_name):
         """Initialize backend."""
         super().__init__(dist_name)
+        self.local_repo_file = "/etc/yum.repos.d/modoboa-installer-local.repo"
         if "centos" in dist_name:
             self.install("epel-release")
 
+    def restore_system(self):
+        utils.exec_cmd("rm -f {}".format(self.local_repo_file))
+
+    def use_local_repository(self, path):
+        """Add local repository, preferred over mirrors."""
+        with self.lock:
+            self.local_repository = path
+            with open(self.local_repo_file, "w") as fp:
+                fp.write(
+                    "[modoboa-installer-local]\n"
+                    "name=Modoboa installer local repository\n"
+                    f"baseurl=file://{path}\n"
+                    "enabled=1\n"
+                    "gpgcheck=0\n"
+                    "priority=1\n"
+                )
+
+    def prefetch(self, names, path):
+        """Download packages and dependencies, then generate an index."""
+        with self.lock:
+            self.local_repository = path
+            os.makedirs(path, exist_ok=True)
+            self.install_many(["yum-utils", "createrepo"])
+            code, output = utils.exec_cmd(
+                "yumdownloader --resolve --destdir {} {}".format(
+                    path, " ".join(names)),
+                tail=utils.ERROR_OUTPUT_LINES)
+            if code:
+                return code, output
+            return utils.exec_cmd(
+                "createrepo {}".format(path), tail=utils.ERROR_OUTPUT_LINES)
+
     def install(self, name):
         """Install a package."""
-        utils.exec_cmd("yum install -y --quiet {}".format(name))
+        with self.lock:
+            self.snapshot_versions()
+            utils.exec_cmd("yum install -y --quiet {}".format(name))
+            self.invalidate_cache()
 
     def install_many(self, names):
         """Install many packages."""
-        return utils.exec_cmd("yum install -y --quiet {}".format(" ".join(names)))
-
-    def get_installed_version(self, name):
-        """Get installed package version."""
+        with self.lock:
+            names = self.get_missing_packages(names)
+            if not names:
+                return 0, b""
+            self.snapshot_versions()
+            code, output = utils.exec_cmd(
+                "yum install -y --quiet {}".format(" ".join(names)),
+                tail=utils.ERROR_OUTPUT_LINES)
+            self.invalidate_cache()
+            if not code:
+                self.installed_packages.update(names)
+            return code, output
+
+    def load_installed_versions(self):
+        """Query the rpm database once."""
         code, output = utils.exec_cmd(
-            "rpm -qi {} | grep Version".format(name))
-        match = re.match(r"Version\s+: (.+)", output.decode())
-        if match:
-            return match.group(1)
-        return None
+            "rpm -qa --queryformat '%{NAME} %{VERSION}\\n'")
+        versions = {}
+        for line in output.decode().splitlines():
+            try:
+                name, version = line.split()
+            except ValueError:
+                continue
+            versions.setdefault(name, version)
+        return versions
 
 
 def get_backend():
@@ -1,12 +1,26 @@
 """Python related tools."""
 
+import hashlib
+import json
 import os
+import pwd
 import sys
 
 from . import package
 from . import utils
 
 
+# Versions returned by get_package_version, per virtualenv
+_VERSIONS = {}
+# Python ABI of virtualenvs, see get_abi_tag
+_ABI_TAGS = {}
+
+
+def invalidate_versions(venv=None):
+    """Forget cached package versions of a virtualenv."""
+    _VERSIONS.pop(venv, None)
+
+
 def get_path(cmd, venv=None):
     """Return path to cmd."""
     path = cmd
@@ -23,31 +37,112 @@ def get_pip_path(venv):
     return binpath
 
 
-def install_package(name, venv=None, upgrade=False, binary=True, **kwargs):
+def get_abi_tag(venv, **kwargs):
+    """Return a tag identifying the Python ABI of a virtualenv."""
+    if venv not in _ABI_TAGS:
+        code, output = utils.exec_cmd(
+            "{} -c 'import platform, sys; print(\"cp{{}}{{}}-{{}}\".format("
+            "sys.version_info[0], sys.version_info[1], "
+            "platform.machine()))'".format(get_path("python3", venv)),
+            **kwargs)
+        if code:
+            return None
+        _ABI_TAGS[venv] = output.decode().strip()
+    return _ABI_TAGS[venv]
+
+
+def get_wheelhouse(config, name, version, venv, owner):
+    """Return the wheelhouse to use for a virtualenv, if enabled.
+
+    Wheels are stored per application, version and Python ABI so they
+    can be reused by other hosts sharing the same directory.
+    """
+    if not config.getboolean("cache", "wheelhouse", fallback=False):
+        return None
+    abi = get_abi_tag(venv, sudo_user=owner)
+    if abi is None:
+        return None
+    path = os.path.join(
+        config.get("cache", "wheelhouse_dir"), name,
+        "{}-{}".format(version, abi))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+        pw = pwd.getpwnam(owner)
+        os.chown(path, pw[2], pw[3])
+    return path
+
+
+def _pip_install(names, venv, options, wheelhouse, refresh, **kwargs):
+    """Run pip install, using wheelhouse when provided.
+
+    Packages are installed from the wheelhouse without contacting the
+    index. Missing wheels are built (or downloaded) once into the
+    wheelhouse, then installed from it.
+    """
+    names = " ".join(names)
+    cmd = "{} install{}".format(get_pip_path(venv), options)
+    if wheelhouse is None:
+        utils.exec_cmd(
+            "{} {}".format(cmd, names), tail=utils.ERROR_OUTPUT_LINES,
+            **kwargs)
+        return
+    offline_cmd = "{} --no-index --find-links {} {}".format(
+        cmd, wheelhouse, names)
+    if not refresh:
+        code, output = utils.exec_cmd(
+            offline_cmd, tail=utils.ERROR_OUTPUT_LINES, **kwargs)
+        if not code:
+            return
+    utils.printcolor(
+        "Populating wheelhouse {}".format(wheelhouse), utils.MAGENTA)
+    code, output = utils.exec_cmd(
+        "{} wheel{} -w {} {}".format(
+            get_pip_path(venv),
+            " --pre" if " --pre" in options else "",
+            wheelhouse, names),
+        tail=utils.ERROR_OUTPUT_LINES, **kwargs)
+    if code:
+        utils.printcolor(
+            "Failed to build wheels, installing from the index",
+            utils.YELLOW)
+        offline_cmd = "{} {}".format(cmd, names)
+    utils.exec_cmd(offline_cmd, tail=utils.ERROR_OUTPUT_LINES, **kwargs)
+
+
+def install_package(name, venv=None, upgrade=False, binary=True,
+                    wheelhouse=None, refresh=False, **kwargs):
     """Install a Python package using pip."""
-    cmd = "{} install{}{}{} {}".format(
-        get_pip_path(venv),
+    options = "{}{}{}".format(
         " -U" if upgrade else "",
         " --no-binary :all:" if not binary else "",
         " --pre" if kwargs.pop("beta", False) else "",
-        name
     )
-    utils.exec_cmd(cmd, **kwargs)
+    _pip_install([name], venv, options, wheelhouse, refresh, **kwargs)
+    invalidate_versions(venv)
 
 
-def install_packages(names, venv=None, upgrade=False, **kwargs):
-    """Install a Python package using pip."""
-    cmd = "{} install{}{} {}".format(
-        get_pip_path(venv),
-        " -U " if upgrade else "",
+def install_packages(names, venv=None, upgrade=False, wheelhouse=None,
+                     refresh=False, **kwargs):
+    """Install Python packages using pip.
+
+    :param str wheelhouse: directory of prebuilt wheels to install from
+    :param bool refresh: update wheelhouse before installing
+    """
+    options = "{}{}".format(
+        " -U" if upgrade else "",
         " --pre" if kwargs.pop("beta", False) else "",
-        " ".join(names)
     )
-    utils.exec_cmd(cmd, **kwargs)
+    _pip_install(names, venv, options, wheelhouse, refresh, **kwargs)
+    invalidate_versions(venv)
 
 
 def get_package_version(name, venv=None, **kwargs):
-    """Returns the version of an installed package."""
+    """Returns the version of an installed package.
+
+    The result is cached until a package is installed in ``venv``.
+    """
+    if name in _VERSIONS.get(venv, {}):
+        return _VERSIONS[venv][name]
     cmd = "{} show {}".format(
         get_pip_path(venv),
         name
@@ -77,6 +172,7 @@ def get_package_version(name, venv=None, **kwargs):
             f"Failed to find the version of {name}",
             utils.RED)
         sys.exit(1)
+    _VERSIONS.setdefault(venv, {})[name] = version_list_clean
     return version_list_clean
 
 
@@ -87,6 +183,7 @@ def install_package_from_repository(name, url, vcs="git", venv=None, **kwargs):
     cmd = "{} install -e {}+{}#egg={}".format(
         get_pip_path(venv), vcs, url, name)
     utils.exec_cmd(cmd, **kwargs)
+    invalidate_versions(venv)
 
 
 def setup_virtualenv(path, sudo_user=None):
@@ -103,3 +200,145 @@ def setup_virtualenv(path, sudo_user=None):
     with utils.settings(sudo_user=sudo_user):
         utils.exec_cmd("{} -m venv {}".format(python_binary, path))
         install_packages(["pip", "setuptools"], venv=path, upgrade=True)
+
+
+def _get_archive_base(config, name, version, packages, abi):
+    """Return the base path of a virtualenv archive and its key.
+
+    The key is a hash of the requested packages, so an archive is only
+    used for the exact same request.
+    """
+    key = hashlib.sha256(
+        json.dumps([abi] + sorted(packages)).encode()).hexdigest()
+    path = os.path.join(
+        config.get("cache", "venv_archive_dir"),
+        "{}-{}-{}-{}".format(name, version, abi, key[:12]))
+    return path, key
+
+
+def _get_archive_abi(config, version):
+    """Return the ABI tag used to key virtualenv archives.
+
+    Virtualenvs are created with the host interpreter, so its tag is
+    used on both sides. Nothing is archived for "latest" requests since
+    the archive would be restored forever, even after new releases.
+
+    :return: the tag, None if archives must not be used
+    """
+    if not config.getboolean("cache", "venv_archive", fallback=False):
+        return None
+    if version == "latest":
+        return None
+    return get_abi_tag(None)
+
+
+def _get_file_hash(path):
+    """Return the sha256 hash of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _relocate_virtualenv(path, old_path):
+    """Replace old_path by path in scripts and configuration of a venv."""
+    files = [os.path.join(path, "pyvenv.cfg")]
+    bindir = os.path.join(path, "bin")
+    files += [os.path.join(bindir, fname) for fname in os.listdir(bindir)]
+    for fname in files:
+        if os.path.islink(fname) or not os.path.isfile(fname):
+            continue
+        with open(fname, "rb") as fp:
+            content = fp.read()
+        if b"\0" in content or old_path.encode() not in content:
+            continue
+        with open(fname, "wb") as fp:
+            fp.write(content.replace(old_path.encode(), path.encode()))
+
+
+def restore_virtualenv(config, name, version, packages, path, sudo_user):
+    """Create a virtualenv from a previously saved archive.
+
+    :return: True if the virtualenv has been restored
+    """
+    if os.path.exists(path):
+        return False
+    abi = _get_archive_abi(config, version)
+    if abi is None:
+        return False
+    base, key = _get_archive_base(config, name, version, packages, abi)
+    archive = base + ".tar.gz"
+    if not os.path.isfile(base + ".json") or not os.path.isfile(archive):
+        return False
+    with open(base + ".json") as fp:
+        manifest = json.load(fp)
+    if manifest.get("requirements_hash") != key:
+        utils.printcolor(
+            "Virtualenv archive {} does not match the requested packages, "
+            "ignoring it".format(archive), utils.YELLOW)
+        return False
+    if _get_file_hash(archive) != manifest["sha256"]:
+        utils.printcolor(
+            "Virtualenv archive {} is corrupted, ignoring it".format(archive),
+            utils.YELLOW)
+        return False
+    utils.printcolor(
+        "Restoring virtualenv from {}".format(archive), utils.MAGENTA)
+    os.makedirs(path)
+    code, output = utils.exec_cmd(
+        "tar -xzf {} -C {}".format(archive, path))
+    if code:
+        utils.printcolor(
+            "Failed to extract virtualenv archive, creating it instead",
+            utils.YELLOW)
+        utils.exec_cmd("rm -rf {}".format(path))
+        return False
+    if manifest["venv_path"] != path:
+        _relocate_virtualenv(path, manifest["venv_path"])
+    utils.exec_cmd("chown -R {}: {}".format(sudo_user, path))
+    invalidate_versions(path)
+    return True
+
+
+def save_virtualenv(config, name, version, packages, path, sudo_user):
+    """Save a virtualenv to an archive reusable by other hosts.
+
+    The archive comes with a manifest containing the exact versions of
+    installed packages and the hash of the archive.
+    """
+    abi = _get_archive_abi(config, version)
+    if abi is None:
+        return
+    if get_abi_tag(path, sudo_user=sudo_user) != abi:
+        # Created by another interpreter (during a previous run)
+        return
+    base, key = _get_archive_base(config, name, version, packages, abi)
+    if os.path.isfile(base + ".json"):
+        return
+    code, lock = utils.exec_cmd(
+        "{} freeze --all".format(get_pip_path(path)), sudo_user=sudo_user)
+    if code:
+        return
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    archive = base + ".tar.gz"
+    code, output = utils.exec_cmd(
+        "tar -czf {} -C {} .".format(archive, path))
+    if code:
+        utils.printcolor(
+            "Failed to save virtualenv archive: {}".format(output.decode()),
+            utils.YELLOW)
+        return
+    manifest = {
+        "name": name,
+        "version": version,
+        "abi": abi,
+        "venv_path": path,
+        "requirements": packages,
+        "requirements_hash": key,
+        "lock": lock.decode().splitlines(),
+        "sha256": _get_file_hash(archive),
+    }
+    with open(base + ".json", "w") as fp:
+        json.dump(manifest, fp, indent=2)
+    utils.success("Virtualenv saved to {}".format(archive))
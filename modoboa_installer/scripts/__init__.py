@@ -1,11 +1,38 @@
 """Installation scripts management."""
 
+import concurrent.futures
 import importlib
+import os
 import sys
 
+from .. import database
+from .. import package
 from .. import utils
 
 
+# Applications which must be completely installed before the given
+# one can start. An application missing from this mapping waits for
+# all the applications listed before it.
+DEPENDENCIES = {
+    "fail2ban": [],
+    "modoboa": [],
+    "pgbouncer": [],
+    # Needs the OAuth2 application created through modoboa's manage.py
+    "radicale": ["modoboa"],
+    # Uses modoboa's instance and user
+    "uwsgi": ["modoboa"],
+    "nginx": ["modoboa"],
+    # generate_postfix_maps is run from modoboa's virtualenv
+    "postfix": ["modoboa"],
+    # Needs create_oauth2_app and modoboa's version
+    "dovecot": ["modoboa"],
+    "amavis": ["modoboa"],
+    # Loads the dkim view into modoboa's database
+    "opendkim": ["modoboa"],
+    "rspamd": ["modoboa"],
+}
+
+
 def load_app_script(appname):
     """Load module corresponding to the given appname."""
     try:
@@ -17,21 +44,189 @@ def load_app_script(appname):
     return script
 
 
+def is_enabled(appname: str, config) -> bool:
+    """Check if an application is enabled in the configuration."""
+    return (
+        not config.has_option(appname, "enabled") or
+        config.getboolean(appname, "enabled")
+    )
+
+
+_INSTALLERS = {}
+
+
+def get_installer(appname: str, config, upgrade: bool, archive_path: str):
+    """Return the installer of an application, creating it only once."""
+    if appname not in _INSTALLERS:
+        script = load_app_script(appname)
+        _INSTALLERS[appname] = getattr(script, appname.capitalize())(
+            config, upgrade, archive_path)
+    return _INSTALLERS[appname]
+
+
 def install(appname: str, config, upgrade: bool, archive_path: str):
     """Install an application."""
-    if (config.has_option(appname, "enabled") and
-            not config.getboolean(appname, "enabled")):
+    if not is_enabled(appname, config):
         return
 
     utils.printcolor("Installing {}".format(appname), utils.MAGENTA)
-    script = load_app_script(appname)
     try:
-        getattr(script, appname.capitalize())(config, upgrade, archive_path).run()
+        get_installer(appname, config, upgrade, archive_path).run()
     except utils.FatalError as inst:
         utils.error("{}".format(inst))
         sys.exit(1)
 
 
+def collect_packages(appnames: list[str], config, upgrade: bool,
+                     archive_path: str):
+    """Return the packages required by all enabled applications.
+
+    Applications installed by other ones are included, as well as the
+    database server if required.
+    """
+    packages = []
+    if config.getboolean("database", "install"):
+        backend = database.get_backend(config)
+        # Repositories must exist before the transaction is planned
+        backend.prepare_packages()
+        packages += backend.get_packages()
+    queue = list(appnames)
+    seen = set()
+    try:
+        while queue:
+            appname = queue.pop(0)
+            if appname in seen or not is_enabled(appname, config):
+                continue
+            seen.add(appname)
+            installer = get_installer(appname, config, upgrade, archive_path)
+            with package.backend.lock:
+                packages += [
+                    name for name in installer.plan_packages()
+                    if name not in packages
+                ]
+            queue += installer.get_extra_apps()
+    except utils.FatalError as inst:
+        utils.error("{}".format(inst))
+        sys.exit(1)
+    return packages
+
+
+def install_packages(appnames: list[str], config, upgrade: bool,
+                     archive_path: str):
+    """Install the packages of all enabled applications at once.
+
+    If the transaction fails, packages will be installed application
+    per application instead.
+    """
+    packages = collect_packages(appnames, config, upgrade, archive_path)
+    if not packages:
+        return
+    utils.printcolor("Installing system packages", utils.MAGENTA)
+    code, output = package.backend.install_many(packages)
+    if code:
+        utils.printcolor(
+            "Failed to install all packages at once, they will be "
+            "installed per application", utils.YELLOW)
+
+
+def get_plan(appnames: list[str], config, upgrade: bool, archive_path: str):
+    """Describe what installing applications would do.
+
+    :return: a list of (appname, steps) tuples, see Installer.get_plan
+    """
+    plans = []
+    queue = list(appnames)
+    seen = set()
+    while queue:
+        appname = queue.pop(0)
+        if appname in seen or not is_enabled(appname, config):
+            continue
+        seen.add(appname)
+        try:
+            installer = get_installer(appname, config, upgrade, archive_path)
+            steps = installer.get_plan()
+            # Applications installed by this one come right after it
+            queue = installer.get_extra_apps() + queue
+        except utils.FatalError as inst:
+            steps = [("plan", "can't be determined before installation "
+                      "({})".format(inst))]
+        plans.append((appname, steps))
+    return plans
+
+
+def prefetch_packages(appnames: list[str], config, extra_packages: list[str]):
+    """Download required packages to the local repository."""
+    path = config.get("cache", "packages_dir")
+    # Repository keys fetched while planning are cached there too
+    package.backend.local_repository = path
+    packages = extra_packages + collect_packages(
+        appnames, config, False, None)
+    utils.printcolor(
+        "Downloading {} packages to {}".format(len(packages), path),
+        utils.MAGENTA)
+    code, output = package.backend.prefetch(packages, path)
+    if code:
+        utils.error("Failed to download packages: {}".format(output.decode()))
+        sys.exit(1)
+    utils.success("Local repository ready in {}".format(path))
+
+
+def _install_from_worker(appname: str, config, upgrade: bool,
+                         archive_path: str):
+    """Install an application and prefix its output with its name."""
+    with utils.settings(log_prefix="[{}] ".format(appname)):
+        install(appname, config, upgrade, archive_path)
+
+
+def install_many(appnames: list[str], config, upgrade: bool,
+                 archive_path: str, jobs: int = 1):
+    """Install applications, running independent ones concurrently.
+
+    Applications are started as soon as all their dependencies (see
+    :data:`DEPENDENCIES`) are installed, using at most ``jobs``
+    workers. Package manager operations stay serialized.
+    """
+    try:
+        utils.load_templates(
+            os.path.join(os.path.dirname(__file__), "files"))
+    except utils.FatalError as inst:
+        utils.error("{}".format(inst))
+        sys.exit(1)
+    if jobs <= 1:
+        for appname in appnames:
+            install(appname, config, upgrade, archive_path)
+        return
+    pending = list(appnames)
+    done = set()
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            for appname in list(pending):
+                dependencies = DEPENDENCIES.get(appname)
+                if dependencies is None:
+                    dependencies = appnames[:appnames.index(appname)]
+                ready = all(
+                    dep in done for dep in dependencies if dep in appnames)
+                if not ready:
+                    continue
+                pending.remove(appname)
+                future = executor.submit(
+                    _install_from_worker, appname, config, upgrade,
+                    archive_path)
+                running[future] = appname
+            if not running:
+                raise utils.FatalError(
+                    "Circular dependency detected between {}"
+                    .format(", ".join(pending)))
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                appname = running.pop(future)
+                # Propagate failures (SystemExit included)
+                future.result()
+                done.add(appname)
+
+
 def backup(appname, config, path):
     """Backup an application."""
     if (config.has_option(appname, "enabled") and
@@ -47,6 +242,28 @@ def backup(appname, config, path):
         sys.exit(1)
 
 
+def _backup_from_worker(appname, config, path):
+    """Backup an application and prefix its output with its name."""
+    with utils.settings(log_prefix="[{}] ".format(appname)):
+        backup(appname, config, path)
+
+
+def backup_many(appnames: list[str], config, path: str, jobs: int = 1):
+    """Backup applications, running up to jobs backups concurrently."""
+    if jobs <= 1:
+        for appname in appnames:
+            backup(appname, config, path)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(_backup_from_worker, appname, config, path)
+            for appname in appnames
+        ]
+        for future in futures:
+            # Propagate failures (SystemExit included)
+            future.result()
+
+
 def restore_prep(restore):
     """Restore instance"""
     script = importlib.import_module(
@@ -3,6 +3,7 @@
 import os
 
 from .. import package
+from .. import tuning
 from .. import utils
 
 from . import base
@@ -25,6 +26,8 @@ class Amavis(base.Installer):
         ],
     }
     with_db = True
+    extra_apps = ["spamassassin", "clamav"]
+    use_db_pooler = True
 
     @property
     def config_dir(self):
@@ -47,6 +50,13 @@ class Amavis(base.Installer):
                 "conf.d/50-user"]
         return ["amavisd.conf"]
 
+    def get_template_context(self):
+        """Additional variables."""
+        context = super().get_template_context()
+        context["max_servers"] = tuning.get_amavis_plan(
+            self.config)["max_servers"]
+        return context
+
     def get_packages(self):
         """Additional packages."""
         packages = super(Amavis, self).get_packages()
@@ -97,13 +107,20 @@ class Amavis(base.Installer):
 
     def pre_run(self):
         """Tasks to run first."""
+        clamav_remote = (
+            self.config.getboolean("clamav", "enabled") and
+            self.config.get("clamav", "servers", fallback="")
+        )
+        if clamav_remote:
+            raise utils.FatalError(
+                "Amavis needs a local clamd, clear clamav servers option")
         with open("/etc/mailname", "w") as fp:
             fp.write("{}\n".format(self.config.get("general", "hostname")))
 
     def post_run(self):
         """Additional tasks."""
-        install("spamassassin", self.config, self.upgrade, self.archive_path)
-        install("clamav", self.config, self.upgrade, self.archive_path)
+        for appname in self.get_extra_apps():
+            install(appname, self.config, self.upgrade, self.archive_path)
 
     def custom_backup(self, path):
         """Backup custom configuration if any."""
@@ -1,5 +1,6 @@
 """Backup script for pre-installed instance."""
 
+import concurrent.futures
 import os
 import pwd
 import shutil
@@ -130,12 +131,7 @@ class Backup:
                         f" ({home_path}) seems not right...")
 
         else:
-            dst = os.path.join(self.backup_path, "mails/")
-
-            if os.path.exists(dst):
-                shutil.rmtree(dst)
-
-            shutil.copytree(home_path, dst)
+            utils.backup_mailboxes(self.config, home_path, self.backup_path)
             utils.printcolor("Mail backup complete!", utils.GREEN)
 
     def custom_config_backup(self):
@@ -159,7 +155,9 @@ class Backup:
             dkim_keys = self.config.get(
                 "opendkim", "keys_storage_dir", fallback="/var/lib/dkim")
             if os.path.isdir(dkim_keys):
-                shutil.copytree(dkim_keys, os.path.join(custom_path, "dkim"))
+                utils.copy_tree(
+                    dkim_keys, os.path.join(custom_path, "dkim"),
+                    workers=utils.get_copy_workers(self.config))
                 utils.printcolor(
                     "DKIM keys saved!", utils.GREEN)
 
@@ -169,8 +167,9 @@ class Backup:
             radicale_backup = os.path.join(self.config.get(
                 "radicale", "home_dir", fallback="/srv/radicale"), "collections")
             if os.path.isdir(radicale_backup):
-                shutil.copytree(radicale_backup, os.path.join(
-                    custom_path, "radicale"))
+                utils.copy_tree(
+                    radicale_backup, os.path.join(custom_path, "radicale"),
+                    workers=utils.get_copy_workers(self.config))
                 utils.printcolor("Radicale files saved", utils.GREEN)
 
         # AMAVIS
@@ -196,9 +195,12 @@ class Backup:
 
         utils.printcolor("Backing up databases...", utils.MAGENTA)
 
-        self.database_dump("modoboa")
-        self.database_dump("amavis")
-        self.database_dump("spamassassin")
+        apps = ["modoboa", "amavis", "spamassassin"]
+        jobs = utils.get_dump_jobs(self.config)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            for future in [pool.submit(self.database_dump, app)
+                           for app in apps]:
+                future.result()
 
     def database_dump(self, app_name):
 
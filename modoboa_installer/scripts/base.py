@@ -8,12 +8,19 @@ from .. import database
 from .. import package
 from .. import python
 from .. import system
+from .. import timing
 from .. import utils
 
 
 class Installer:
     """Simple installer for one application."""
 
+    # Phases executed by run(), in order
+    phases: list[str] = [
+        "pre_run", "install_packages", "setup_user", "setup_database",
+        "install_config_files", "post_run", "restore", "restart_daemon"
+    ]
+
     appname: str
     no_daemon: bool = False
     daemon_name: Optional[str] = None
@@ -21,6 +28,10 @@ class Installer:
     with_user: bool = False
     with_db: bool = False
     config_files: list[str] = []
+    # Applications installed by this one (during post_run)
+    extra_apps: list[str] = []
+    # Connect to the database through PgBouncer when it is enabled
+    use_db_pooler: bool = False
 
     def __init__(self, config, upgrade: bool, archive_path: str) -> None:
         """Get configuration."""
@@ -37,7 +48,16 @@ class Installer:
         self.dbhost = self.config.get("database", "host")
         self.dbport = self.config.get(
             "database", "port", fallback=self.backend.default_port)
+        self.db_pooled = (
+            self.use_db_pooler and database.is_pooler_enabled(self.config))
+        if self.db_pooled:
+            self.dbhost = database.POOLER_HOST
+            self.dbport = self.config.get("pgbouncer", "port")
         self._config_dir = None
+        self._packages_prepared = False
+        # Set when configuration files or packages are modified
+        self.config_changed = False
+        self.packages_changed = False
         if not self.with_db:
             return
         self.dbname = self.config.get(self.appname, "dbname")
@@ -47,11 +67,19 @@ class Installer:
     @property
     def modoboa_2_2_or_greater(self) -> bool:
         # Check if modoboa version > 2.2
-        modoboa_version = python.get_package_version(
-            "modoboa",
-            self.config.get("modoboa", "venv_path"),
-            sudo_user=self.config.get("modoboa", "user")
-            )
+        venv_path = self.config.get("modoboa", "venv_path")
+        version = self.config.get("modoboa", "version")
+        if not os.path.exists(venv_path):
+            # Not installed yet (--plan), rely on the requested version
+            if version == "latest":
+                return True
+            modoboa_version = version.split(".")
+        else:
+            modoboa_version = python.get_package_version(
+                "modoboa",
+                venv_path,
+                sudo_user=self.config.get("modoboa", "user")
+                )
         condition = (
             (int(modoboa_version[0]) == 2 and int(modoboa_version[1]) >= 2) or
             int(modoboa_version[0]) > 2
@@ -76,9 +104,9 @@ class Installer:
             f"Trying to restore {self.appname} database from backup.",
             utils.MAGENTA
         )
-        database_backup_path = os.path.join(
-            self.archive_path, f"databases/{self.appname}.sql")
-        if os.path.isfile(database_backup_path):
+        database_backup_path = database.find_dump(
+            os.path.join(self.archive_path, "databases"), self.appname)
+        if database_backup_path:
             utils.success(f"SQL dump found in backup for {self.appname}!")
             return database_backup_path
         return None
@@ -94,8 +122,9 @@ class Installer:
         """Setup a database."""
         if not self.with_db:
             return
-        self.backend.create_user(self.dbuser, self.dbpasswd)
-        self.backend.create_database(self.dbname, self.dbuser)
+        with self.backend.batch():
+            self.backend.create_user(self.dbuser, self.dbpasswd)
+            self.backend.create_database(self.dbname, self.dbuser)
         schema = None
         if self.archive_path:
             schema = self.get_sql_schema_from_backup()
@@ -116,11 +145,20 @@ class Installer:
             self.home_dir = None
         system.create_user(self.user, self.home_dir)
 
+    def get_dbi_driver(self):
+        """Return the Perl DBI driver to use in data source names."""
+        if self.dbengine != "postgres":
+            return self.dbengine
+        if self.db_pooled:
+            # Server side prepared statements don't survive
+            # transaction pooling
+            return "Pg(pg_server_prepare=>0)"
+        return "Pg"
+
     def get_template_context(self):
         """Return context used for template rendering."""
         context = {
-            "dbengine": (
-                "Pg" if self.dbengine == "postgres" else self.dbengine),
+            "dbengine": self.get_dbi_driver(),
             "dbhost": self.dbhost,
             "dbport": self.dbport,
         }
@@ -138,29 +176,43 @@ class Installer:
 
     def get_packages(self):
         """Return the list of packages to install."""
-        return self.packages.get(package.backend.FORMAT, {})
+        # Copy: subclasses extend the result
+        return list(self.packages.get(package.backend.FORMAT, []))
+
+    def get_extra_apps(self):
+        """Return the applications installed by this one."""
+        return self.extra_apps
+
+    def prepare_packages(self):
+        """Configure repositories and preseed packages if needed."""
+        pass
+
+    def plan_packages(self):
+        """Prepare package installation and return packages to install."""
+        if not self._packages_prepared:
+            self.prepare_packages()
+            self._packages_prepared = True
+        return self.get_packages()
 
     def install_packages(self):
         """Install required packages."""
-        packages = self.get_packages()
+        packages = self.plan_packages()
         if not packages:
             return
         exitcode, output = package.backend.install_many(packages)
         if exitcode:
             utils.error("Failed to install dependencies")
             sys.exit(1)
+        self.packages_changed = package.backend.packages_changed(packages)
 
     def get_config_files(self):
         """Return the list of configuration files to copy."""
-        return self.config_files
+        return list(self.config_files)
 
-    def install_config_files(self):
-        """Install configuration files."""
-        config_files = self.get_config_files()
-        if not config_files:
-            return
-        context = self.get_template_context()
-        for ftpl in config_files:
+    def get_config_templates(self):
+        """Return (template, destination) tuples of configuration files."""
+        templates = []
+        for ftpl in self.get_config_files():
             if "=" in ftpl:
                 ftpl, dstname = ftpl.split("=")
             else:
@@ -169,7 +221,69 @@ class Installer:
             dst = dstname
             if not dst.startswith("/"):
                 dst = os.path.join(self.config_dir, dst)
-            utils.copy_from_template(src, dst, context)
+            templates.append((src, dst))
+        return templates
+
+    def install_config_files(self):
+        """Install configuration files."""
+        config_templates = self.get_config_templates()
+        if not config_templates:
+            return
+        context = self.get_template_context()
+        templates = [(src, dst, context) for src, dst in config_templates]
+        if any(utils.render_templates(templates)):
+            self.config_changed = True
+
+    def get_plan_commands(self):
+        """Return notable commands run by this installer.
+
+        :return: a list of (phase, command) tuples
+        """
+        return []
+
+    def get_plan(self):
+        """Describe what run() would do, without doing anything.
+
+        :return: a list of (phase, description) tuples
+        """
+        steps = []
+        packages = self.get_packages()
+        if packages:
+            steps.append(("install_packages", " ".join(packages)))
+        if self.with_user:
+            steps.append((
+                "setup_user",
+                "create user {}".format(self.config.get(self.appname, "user"))
+            ))
+        if self.with_db and not self.upgrade:
+            steps.append((
+                "setup_database",
+                "create database {} owned by {}".format(
+                    self.dbname, self.dbuser)
+            ))
+        try:
+            steps += [
+                ("install_config_files", dst)
+                for src, dst in self.get_config_templates()
+            ]
+        except utils.FatalError as inst:
+            steps.append((
+                "install_config_files",
+                "files can't be determined yet ({})".format(inst)
+            ))
+        steps += self.get_plan_commands()
+        if self.archive_path:
+            steps.append(("restore", "restore from {}".format(
+                self.archive_path)))
+        if not self.no_daemon:
+            steps.append((
+                "restart_daemon",
+                "restart {}{}".format(
+                    self.get_daemon_name(),
+                    " if changed" if self.upgrade else "")
+            ))
+        steps.sort(key=lambda step: self.phases.index(step[0]))
+        return steps
 
     def backup(self, path):
         if self.with_db:
@@ -189,25 +303,50 @@ class Installer:
         """Return daemon name if defined."""
         return self.daemon_name if self.daemon_name else self.appname
 
+    def needs_restart(self):
+        """Tell if the daemon must be restarted.
+
+        Upgrades only restart daemons whose configuration or packages
+        changed.
+        """
+        return (
+            not self.upgrade or bool(self.archive_path) or
+            self.config_changed or self.packages_changed
+        )
+
     def restart_daemon(self):
         """Restart daemon process."""
         if self.no_daemon:
             return
         name = self.get_daemon_name()
-        system.enable_and_start_service(name)
+        system.enable_and_start_service(name, restart=self.needs_restart())
+
+    def _timed(self, phase):
+        """Record the duration of an installation phase."""
+        return timing.step(
+            "{}.{}".format(self.appname, phase), "phase", app=self.appname)
 
     def run(self):
         """Run the installer."""
-        self.pre_run()
-        self.install_packages()
-        self.setup_user()
+        with self._timed("pre_run"):
+            self.pre_run()
+        # Keep preseeding, repository setup and installation together
+        with self._timed("install_packages"), package.backend.lock:
+            self.install_packages()
+        with self._timed("setup_user"):
+            self.setup_user()
         if not self.upgrade:
-            self.setup_database()
-        self.install_config_files()
-        self.post_run()
+            with self._timed("setup_database"):
+                self.setup_database()
+        with self._timed("install_config_files"):
+            self.install_config_files()
+        with self._timed("post_run"):
+            self.post_run()
         if self.archive_path:
-            self.restore()
-        self.restart_daemon()
+            with self._timed("restore"):
+                self.restore()
+        with self._timed("restart_daemon"):
+            self.restart_daemon()
 
     def _dump_database(self, backup_path: str):
         """Create a new database dump for this app."""
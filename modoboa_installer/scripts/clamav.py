@@ -1,6 +1,10 @@
 """ClamAV related tools."""
 
+import os
+import re
+
 from .. import package
+from .. import tuning
 from .. import utils
 from .. import system
 
@@ -38,6 +42,44 @@ class Clamav(base.Installer):
             return ["sysconfig/clamd.amavisd", "tmpfiles.d/clamd.amavisd.conf"]
         return []
 
+    def get_clamd_config_path(self):
+        """Return the path of clamd's configuration file."""
+        if package.backend.FORMAT == "rpm":
+            return "/etc/clamd.d/amavisd.conf"
+        return "/etc/clamav/clamd.conf"
+
+    def update_clamd_config(self):
+        """Set managed options in clamd's configuration file."""
+        options = tuning.get_clamav_settings(self.config)
+        path = self.get_clamd_config_path()
+        if not os.path.isfile(path):
+            # Provided by amavisd-new on RedHat based systems
+            utils.printcolor(
+                "{} not found, clamd settings left unchanged".format(path),
+                utils.YELLOW)
+            return
+        with open(path) as fp:
+            content = fp.read()
+        new_content = content
+        for name, value in options.items():
+            line = "{} {}".format(name, value)
+            pattern = re.compile(
+                r"^#?[ \t]*{}\s.*$".format(re.escape(name)), re.MULTILINE)
+            if pattern.search(new_content):
+                new_content = pattern.sub(line, new_content, count=1)
+            else:
+                new_content = new_content.rstrip("\n") + "\n" + line + "\n"
+        if new_content == content:
+            return
+        utils.backup_file(path)
+        with open(path, "w") as fp:
+            fp.write(new_content)
+        self.config_changed = True
+
+    def get_plan_commands(self):
+        """Signatures are downloaded after installation."""
+        return [("post_run", "freshclam")]
+
     def post_run(self):
         """Additional tasks."""
         if package.backend.FORMAT == "deb":
@@ -68,6 +110,8 @@ WantedBy=multi-user.target
 EOM
 """.format(path))
 
+        self.update_clamd_config()
+
         if utils.dist_name() in ["debian", "ubuntu"]:
             # Stop freshclam daemon to allow manual download
             utils.exec_cmd("service clamav-freshclam stop")
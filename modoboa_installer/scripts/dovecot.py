@@ -1,6 +1,7 @@
 """Dovecot related tools."""
 
 import glob
+import grp
 import os
 import pwd
 import shutil
@@ -9,6 +10,7 @@ import stat
 from .. import database
 from .. import package
 from .. import system
+from .. import tuning
 from .. import utils
 
 from . import base
@@ -49,11 +51,15 @@ class Dovecot(base.Installer):
         ],
     }
     with_user = True
+    use_db_pooler = True
 
     @property
     def version(self) -> str:
         if not hasattr(self, "_version"):
-            self._version = package.backend.get_installed_version("dovecot-core")[:3]
+            version = package.backend.get_installed_version("dovecot-core")
+            if version is None:
+                raise utils.FatalError("dovecot-core is not installed")
+            self._version = version[:3]
         return self._version
 
     def setup_user(self):
@@ -63,7 +69,7 @@ class Dovecot(base.Installer):
         system.create_user(self.mailboxes_owner, self.home_dir)
 
     def _get_config_files_for_version(self, version: str) -> list[str]:
-        files = self.per_version_config_files[version]
+        files = list(self.per_version_config_files[version])
         if version == "2.4":
             files += [
                 f"conf.d/auth-sql-{self.dbengine}.conf.ext=conf.d/auth-sql.conf.ext",
@@ -112,7 +118,7 @@ class Dovecot(base.Installer):
             ]
         return packages
 
-    def install_packages(self):
+    def prepare_packages(self):
         """Preconfigure Dovecot if needed."""
         name, version = utils.dist_info()
         name = name.lower()
@@ -122,7 +128,6 @@ class Dovecot(base.Installer):
         package.backend.preconfigure(
             "dovecot-core", "create-ssl-cert", "boolean", "false"
         )
-        super().install_packages()
 
     def get_template_context(self):
         """Additional variables."""
@@ -189,6 +194,7 @@ class Dovecot(base.Installer):
                 "radicale_user": self.config.get("radicale", "user"),
             }
         )
+        context.update(tuning.get_dovecot_settings(self.config))
         return context
 
     def install_config_files(self):
@@ -227,7 +233,8 @@ class Dovecot(base.Installer):
             )
         for f in glob.glob(f"{self.get_file_path(f'{self.version}/conf.d')}/*"):
             if os.path.isfile(f):
-                utils.copy_file(f, "{}/conf.d".format(self.config_dir))
+                if utils.copy_file(f, "{}/conf.d".format(self.config_dir)):
+                    self.config_changed = True
         # Make postlogin script executable
         utils.exec_cmd("chmod +x /usr/local/bin/postlogin.sh")
         # Only root should have read access to the 10-ssl-keys.try
@@ -252,11 +259,12 @@ class Dovecot(base.Installer):
 
         """
         code, output = utils.exec_cmd("service dovecot status")
-        action = "start" if code else "restart"
-        utils.exec_cmd(
-            "service {} {} > /dev/null 2>&1".format(self.appname, action),
-            capture_output=False,
-        )
+        if code or self.needs_restart():
+            action = "start" if code else "restart"
+            utils.exec_cmd(
+                "service {} {} > /dev/null 2>&1".format(self.appname, action),
+                capture_output=False,
+            )
         system.enable_service(self.get_daemon_name())
 
     def backup(self, path):
@@ -270,10 +278,7 @@ class Dovecot(base.Installer):
             )
             return
 
-        dst = os.path.join(path, "mails/")
-        if os.path.exists(dst):
-            shutil.rmtree(dst)
-        shutil.copytree(home_dir, dst)
+        utils.backup_mailboxes(self.config, home_dir, path)
         utils.success("Mail backup complete!")
 
     def restore(self):
@@ -284,16 +289,13 @@ class Dovecot(base.Installer):
             utils.success("Copying mail backup over dovecot directory.")
             if os.path.exists(home_dir):
                 shutil.rmtree(home_dir)
-            shutil.copytree(mail_dir, home_dir)
-            # Resetting permission for vmail
-            for dirpath, dirnames, filenames in os.walk(home_dir):
-                shutil.chown(dirpath, self.mailboxes_owner, self.mailboxes_owner)
-                for filename in filenames:
-                    shutil.chown(
-                        os.path.join(dirpath, filename),
-                        self.mailboxes_owner,
-                        self.mailboxes_owner,
-                    )
+            # Files are given to vmail while being copied
+            utils.copy_tree(
+                mail_dir, home_dir,
+                workers=utils.get_copy_workers(self.config),
+                uid=pwd.getpwnam(self.mailboxes_owner).pw_uid,
+                gid=grp.getgrnam(self.mailboxes_owner).gr_gid,
+            )
         else:
             utils.printcolor(
                 "It seems that emails were not backed up, skipping restoration.",
@@ -1,10 +1,10 @@
 #default_process_limit = 100
-#default_client_limit = 1000
+default_client_limit = %{default_client_limit}
 
 # Default VSZ (virtual memory size) limit for service processes. This is mainly
 # intended to catch and kill processes that leak memory before they eat up
 # everything.
-#default_vsz_limit = 256M
+default_vsz_limit = %{vsz_limit}
 
 # Login user is internally used by login processes. This is the most untrusted
 # user in Dovecot system. It shouldn't have access to anything at all.
@@ -14,6 +14,16 @@
 # login user, so that login processes can't disturb other processes.
 #default_internal_user = dovecot
 
+# Cache authentication lookups to avoid querying the database on each
+# login.
+auth_cache_size = %{auth_cache_size}
+auth_cache_ttl = %{auth_cache_ttl}
+auth_cache_negative_ttl = %{auth_cache_negative_ttl}
+
+# Maximum number of IMAP connections allowed for a user from each IP
+# address.
+mail_max_userip_connections = %{mail_max_userip_connections}
+
 service imap-login {
   inet_listener imap {
     #port = 143
@@ -26,13 +36,13 @@ service imap-login {
   # Number of connections to handle before starting a new process. Typically
   # the only useful values are 0 (unlimited) or 1. 1 is more secure, but 0
   # is faster. <doc/wiki/LoginProcess.txt>
-  #service_count = 1
+  service_count = 0
 
   # Number of processes to always keep waiting for more connections.
-  #process_min_avail = 0
+  process_min_avail = %{login_process_min_avail}
 
   # If you set service_count=0, you probably need to grow this.
-  #vsz_limit = $default_vsz_limit
+  vsz_limit = %{vsz_limit}
 }
 
 service pop3-login {
@@ -0,0 +1,28 @@
+;; PgBouncer configuration, generated by modoboa-installer
+
+[databases]
+* = host=%dbhost port=%dbport
+
+[pgbouncer]
+logfile = %logfile
+pidfile = %pidfile
+
+listen_addr = %pooler_host
+listen_port = %port
+unix_socket_dir = %unix_socket_dir
+
+auth_type = scram-sha-256
+auth_file = %config_dir/userlist.txt
+
+;; Server connections are only held during transactions
+pool_mode = %pool_mode
+max_client_conn = %max_client_conn
+default_pool_size = %default_pool_size
+reserve_pool_size = 5
+reserve_pool_timeout = 3
+
+server_idle_timeout = 600
+server_lifetime = 3600
+
+;; Sent by some clients (JDBC, psql) but unsupported in transaction mode
+ignore_startup_parameters = extra_float_digits,options
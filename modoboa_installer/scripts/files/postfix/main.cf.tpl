@@ -34,6 +34,18 @@ proxy_read_maps =
         proxy:%{db_driver}:/etc/postfix/sql-spliteddomains-transport.cf
         proxy:%{db_driver}:/etc/postfix/sql-transport.cf
 
+## Performance settings (%{postfix_profile} profile)
+#
+default_process_limit = %{postfix_default_process_limit}
+smtpd_client_connection_count_limit = %{postfix_smtpd_client_connection_count_limit}
+smtp_destination_concurrency_limit = %{postfix_smtp_destination_concurrency_limit}
+lmtp_destination_concurrency_limit = %{postfix_lmtp_destination_concurrency_limit}
+queue_run_delay = %{postfix_queue_run_delay}
+minimal_backoff_time = %{postfix_minimal_backoff_time}
+maximal_backoff_time = %{postfix_maximal_backoff_time}
+smtp_connection_cache_on_demand = yes
+smtp_tls_session_cache_database = btree:${data_directory}/smtp_scache
+
 ## TLS settings
 #
 smtpd_use_tls = yes
@@ -11,7 +11,7 @@
 # ==========================================================================
 %{rspamd_disabled}smtp      inet  n       -       -       -       1       postscreen
 %{rspamd_enabled}smtp      inet  n       -       -       -       -       smtpd
-smtpd     pass  -       -       -       -       -       smtpd
+smtpd     pass  -       -       -       -       %{smtpd_maxproc}       smtpd
 %{amavis_enabled}  -o smtpd_proxy_filter=inet:[127.0.0.1]:10024 
 %{amavis_enabled}  -o smtpd_proxy_options=speed_adjust
 dnsblog   unix  -       -       -       -       0       dnsblog
@@ -54,7 +54,7 @@ defer     unix  -       -       -       -       0       bounce
 trace     unix  -       -       -       -       0       bounce
 verify    unix  -       -       -       -       1       verify
 flush     unix  n       -       -       1000?   0       flush
-proxymap  unix  -       -       n       -       -       proxymap
+proxymap  unix  -       -       n       -       %{postfix_proxymap_process_limit}       proxymap
 proxywrite unix -       -       n       -       1       proxymap
 smtp      unix  -       -       -       -       -       smtp
 relay     unix  -       -       -       -       -       smtp
@@ -6,7 +6,7 @@ clamav {
   timeout = 30;
   symbol = "CLAM_VIRUS";
   type = "clamav";
-  servers = "127.0.0.1:3310"
+  servers = "%clamav_servers"
   patterns {
     # symbol_name = "pattern";
     JUST_EICAR = "Test.EICAR";
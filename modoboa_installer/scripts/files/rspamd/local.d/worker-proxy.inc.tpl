@@ -1,3 +1,9 @@
+# Messages are scanned by the proxy itself (self_scan), so its workers
+# bound the scanning throughput
+count = %worker_count;
+# Concurrent connections are bounded by open files
+max_files = %proxy_max_files;
+
 upstream "local" {
   self_scan = yes;
 }
@@ -5,8 +5,16 @@ plugins = %uwsgi_plugin
 home = %app_venv_path
 chdir = %app_instance_path
 module = instance.wsgi:application
+touch-reload = %app_reload_file
 master = true
 processes = %nb_processes
+threads = %nb_threads
+%{uwsgi_cheaper_enabled}cheaper-algo = spare
+%{uwsgi_cheaper_enabled}cheaper = %uwsgi_cheaper
+%{uwsgi_cheaper_enabled}cheaper-initial = %uwsgi_cheaper_initial
+%{uwsgi_cheaper_enabled}cheaper-step = %uwsgi_cheaper_step
+listen = %uwsgi_listen
+harakiri = %harakiri
 vhost = true
 no-default-app = true
 socket = %uwsgi_socket_path
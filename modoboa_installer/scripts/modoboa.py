@@ -9,14 +9,22 @@ import stat
 import sys
 
 from .. import compatibility_matrix
+from .. import constants
 from .. import package
 from .. import python
 from .. import system
+from .. import tuning
 from .. import utils
 
 from . import base
 
 
+# Main Redis configuration file, depending on the distribution
+REDIS_CONFIG_FILES = ["/etc/redis/redis.conf", "/etc/redis.conf"]
+# Included by the main configuration file, in the same directory
+REDIS_TUNING_CONFIG_NAME = "redis-modoboa-installer.conf"
+
+
 class Modoboa(base.Installer):
     """Modoboa installation."""
 
@@ -70,7 +78,6 @@ class Modoboa(base.Installer):
 
     def _setup_venv(self):
         """Prepare a dedicated virtualenv."""
-        python.setup_virtualenv(self.venv_path, sudo_user=self.user)
         packages = []
         version = self.config.get("modoboa", "version")
         extras = "postgresql"
@@ -106,12 +113,26 @@ class Modoboa(base.Installer):
         if sys.version_info.major == 2 and sys.version_info.micro < 9:
             # Add extra packages to fix the SNI issue
             packages += ["pyOpenSSL"]
+        beta = self.config.getboolean("modoboa", "install_beta")
+        archive_args = (
+            self.config, "modoboa", version,
+            packages + (["--pre"] if beta else []), self.venv_path,
+            self.user)
+        if not self.upgrade and python.restore_virtualenv(*archive_args):
+            return
+        python.setup_virtualenv(self.venv_path, sudo_user=self.user)
+        wheelhouse = python.get_wheelhouse(
+            self.config, "modoboa", version, self.venv_path, self.user)
         python.install_packages(
             packages, self.venv_path,
             upgrade=self.upgrade,
             sudo_user=self.user,
-            beta=self.config.getboolean("modoboa", "install_beta")
+            beta=beta,
+            wheelhouse=wheelhouse,
+            # "latest" wheels must be refreshed to get new releases
+            refresh=version == "latest"
         )
+        python.save_virtualenv(*archive_args)
 
     def _deploy_instance(self):
         """Deploy Modoboa."""
@@ -170,7 +191,8 @@ class Modoboa(base.Installer):
         code, output = utils.exec_cmd(
             "bash -c '{} modoboa-admin.py deploy instance {}'".format(
                 prefix, " ".join(args)),
-            sudo_user=self.user, cwd=self.home_dir)
+            sudo_user=self.user, cwd=self.home_dir,
+            tail=utils.ERROR_OUTPUT_LINES)
         if code:
             raise utils.FatalError(output)
         if self.upgrade and self.opendkim_enabled and self.dbengine == "postgres":
@@ -186,11 +208,12 @@ class Modoboa(base.Installer):
 
     def setup_database(self):
         """Additional config."""
-        super().setup_database()
-        if not self.amavis_enabled:
-            return
-        self.backend.grant_access(
-            self.config.get("amavis", "dbname"), self.dbuser)
+        with self.backend.batch():
+            super().setup_database()
+            if not self.amavis_enabled:
+                return
+            self.backend.grant_access(
+                self.config.get("amavis", "dbname"), self.dbuser)
 
     def get_packages(self):
         """Include extra packages if needed."""
@@ -204,6 +227,14 @@ class Modoboa(base.Installer):
             packages += ["openssl-devel"]
         return packages
 
+    def get_plan_commands(self):
+        """Virtualenv setup and instance deployment."""
+        return [
+            ("setup_user", "{} install".format(
+                python.get_pip_path(self.venv_path))),
+            ("post_run", "modoboa-admin.py deploy instance"),
+        ]
+
     def setup_user(self):
         super().setup_user()
         self._setup_venv()
@@ -302,15 +333,60 @@ class Modoboa(base.Installer):
         self.backend._exec_query(
             query, self.dbname, self.dbuser, self.dbpasswd)
 
+    def setup_redis(self):
+        """Size Redis memory from host resources.
+
+        Settings are written to a separate file included at the end
+        of the main configuration file.
+
+        :return: True if settings have changed
+        """
+        main_config = next(
+            (path for path in REDIS_CONFIG_FILES if os.path.isfile(path)),
+            None)
+        if main_config is None:
+            utils.error("Redis configuration file not found, "
+                        "memory settings left unchanged")
+            return False
+        path = os.path.join(
+            os.path.dirname(main_config), REDIS_TUNING_CONFIG_NAME)
+        settings = tuning.get_redis_settings(self.config)
+        changed = utils.write_config_file(path, "".join(
+            "{} {}\n".format(name, value)
+            for name, value in settings.items()
+        ))
+        include = "include {}".format(path)
+        with open(main_config) as fp:
+            lines = fp.read().splitlines()
+        if include not in lines:
+            with open(main_config, "a") as fp:
+                fp.write("\n{}\n".format(include))
+            changed = True
+        return changed
+
+    def reload_application(self):
+        """Make uWSGI load the new code and settings.
+
+        uWSGI watches this file (touch-reload), so upgrades don't depend
+        on its own configuration having changed.
+        """
+        path = os.path.join(self.home_dir, constants.UWSGI_RELOAD_FILE)
+        with open(path, "a"):
+            os.utime(path)
+        pw = pwd.getpwnam(self.user)
+        os.chown(path, pw[2], pw[3])
+
     def post_run(self):
         """Additional tasks."""
+        restart = self.setup_redis()
         if 'centos' in utils.dist_name():
-            system.enable_and_start_service("redis")
+            system.enable_and_start_service("redis", restart=restart)
         else:
-            system.enable_and_start_service("redis-server")
+            system.enable_and_start_service("redis-server", restart=restart)
         self._deploy_instance()
         if not self.upgrade:
             self.apply_settings()
+        self.reload_application()
 
         if 'centos' in utils.dist_name():
             supervisor = "supervisord"
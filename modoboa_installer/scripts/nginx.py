@@ -9,6 +9,8 @@ from .. import utils
 from . import base
 from .uwsgi import Uwsgi
 
+DHPARAM_COMMAND = "openssl dhparam -dsaparam -out dhparam.pem 4096"
+
 
 class Nginx(base.Installer):
     """Nginx installer."""
@@ -31,18 +33,18 @@ class Nginx(base.Installer):
         })
         return context
 
-    def _setup_config(self, app, hostname=None, extra_config=None):
-        """Custom app configuration."""
-        if hostname is None:
-            hostname = self.config.get("general", "hostname")
-        context = self.get_template_context()
-        context.update({"hostname": hostname, "extra_config": extra_config})
-        src = self.get_file_path("{}.conf.tpl".format(app))
-        group = None
+    def _get_config_destination(self, hostname):
+        """Return the path of a virtual host configuration file."""
         if package.backend.FORMAT == "deb":
-            dst = os.path.join(
+            return os.path.join(
                 self.config_dir, "sites-available", "{}.conf".format(hostname))
-            utils.copy_from_template(src, dst, context)
+        return os.path.join(
+            self.config_dir, "conf.d", "{}.conf".format(hostname))
+
+    def _enable_config(self, app, dst):
+        """Enable a virtual host and give nginx access to the app."""
+        group = None
+        if package.backend.FORMAT == "deb":
             link = os.path.join(
                 self.config_dir, "sites-enabled", os.path.basename(dst))
             if os.path.exists(link):
@@ -52,21 +54,43 @@ class Nginx(base.Installer):
                 group = self.config.get(app, "user")
             user = "www-data"
         else:
-            dst = os.path.join(
-                self.config_dir, "conf.d", "{}.conf".format(hostname))
-            utils.copy_from_template(src, dst, context)
             group = "uwsgi"
             user = "nginx"
         if user and group:
             system.add_user_to_group(user, group)
 
+    def _setup_configs(self, vhosts):
+        """Custom apps configuration.
+
+        :param list vhosts: (app, hostname, extra_config) tuples
+        """
+        context = self.get_template_context()
+        templates = []
+        for app, hostname, extra_config in vhosts:
+            if hostname is None:
+                hostname = self.config.get("general", "hostname")
+            templates.append((
+                self.get_file_path("{}.conf.tpl".format(app)),
+                self._get_config_destination(hostname),
+                dict(context, hostname=hostname, extra_config=extra_config)
+            ))
+        if any(utils.render_templates(templates)):
+            self.config_changed = True
+        for vhost, template in zip(vhosts, templates):
+            self._enable_config(vhost[0], template[1])
+
+    def get_plan_commands(self):
+        """Generating DH parameters takes a while."""
+        if os.path.exists("{}/dhparam.pem".format(self.config_dir)):
+            return []
+        return [("post_run", DHPARAM_COMMAND)]
+
     def post_run(self):
         """Additionnal tasks."""
         extra_modoboa_config = ""
 
-        hostname = "autoconfig.{}".format(
+        autoconfig_hostname = "autoconfig.{}".format(
             self.config.get("general", "domain"))
-        self._setup_config("autoconfig", hostname)
 
         if self.config.get("radicale", "enabled"):
             extra_modoboa_config += """
@@ -77,9 +101,10 @@ class Nginx(base.Installer):
         proxy_pass_header Authorization;
     }
 """
-        self._setup_config(
-            "modoboa", extra_config=extra_modoboa_config)
+        self._setup_configs([
+            ("autoconfig", autoconfig_hostname, None),
+            ("modoboa", None, extra_modoboa_config),
+        ])
 
         if not os.path.exists("{}/dhparam.pem".format(self.config_dir)):
-            cmd = "openssl dhparam -dsaparam -out dhparam.pem 4096"
-            utils.exec_cmd(cmd, cwd=self.config_dir)
+            utils.exec_cmd(DHPARAM_COMMAND, cwd=self.config_dir)
@@ -2,7 +2,6 @@
 
 import os
 import pwd
-import shutil
 import stat
 
 from .. import database
@@ -21,6 +20,7 @@ class Opendkim(base.Installer):
         "rpm": ["opendkim"]
     }
     config_files = ["opendkim.conf", "opendkim.hosts"]
+    use_db_pooler = True
 
     def get_packages(self):
         """Additional packages."""
@@ -129,6 +129,8 @@ class Opendkim(base.Installer):
     def custom_backup(self, path):
         """Backup DKIM keys."""
         if os.path.isdir(self.app_config["keys_storage_dir"]):
-            shutil.copytree(self.app_config["keys_storage_dir"], os.path.join(path, "dkim"))
+            utils.copy_tree(
+                self.app_config["keys_storage_dir"], os.path.join(path, "dkim"),
+                workers=utils.get_copy_workers(self.config))
             utils.printcolor(
                 "DKIM keys saved!", utils.GREEN)
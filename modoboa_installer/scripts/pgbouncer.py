@@ -0,0 +1,84 @@
+"""PgBouncer related tools."""
+
+import os
+import pwd
+
+from .. import database
+from .. import package
+from .. import tuning
+from .. import utils
+
+from . import base
+
+
+class Pgbouncer(base.Installer):
+    """PgBouncer installer."""
+
+    appname = "pgbouncer"
+    packages = {
+        "deb": ["pgbouncer"],
+        "rpm": ["pgbouncer"],
+    }
+    config_files = ["pgbouncer.ini"]
+    # Sections holding the credentials of applications using the pooler
+    client_sections = ["modoboa", "amavis", "spamassassin", "opendkim"]
+
+    def pre_run(self):
+        """Check the database engine."""
+        if self.dbengine != "postgres":
+            raise utils.FatalError(
+                "PgBouncer can only be used with PostgreSQL")
+
+    def get_system_user(self):
+        """Return the user PgBouncer runs as."""
+        if package.backend.FORMAT == "deb":
+            return "postgres"
+        return "pgbouncer"
+
+    def get_template_context(self):
+        """Additional variables."""
+        context = super().get_template_context()
+        if package.backend.FORMAT == "deb":
+            run_dir = "/var/run/postgresql"
+            logfile = "/var/log/postgresql/pgbouncer.log"
+        else:
+            run_dir = "/var/run/pgbouncer"
+            logfile = "/var/log/pgbouncer/pgbouncer.log"
+        context.update({
+            "pooler_host": database.POOLER_HOST,
+            "logfile": logfile,
+            "pidfile": os.path.join(run_dir, "pgbouncer.pid"),
+            "unix_socket_dir": run_dir,
+        })
+        context.update(tuning.get_pgbouncer_settings(self.config))
+        return context
+
+    def get_users(self):
+        """Return credentials of applications using the pooler."""
+        users = {}
+        for section in self.client_sections:
+            # modoboa has no enabled option: it is always installed
+            enabled = self.config.getboolean(
+                section, "enabled", fallback=True)
+            if not enabled or not self.config.has_option(section, "dbuser"):
+                continue
+            users[self.config.get(section, "dbuser")] = self.config.get(
+                section, "dbpassword")
+        return users
+
+    def install_userlist(self):
+        """Generate the authentication file."""
+        content = "".join(
+            '"{}" "{}"\n'.format(user, password.replace('"', '""'))
+            for user, password in sorted(self.get_users().items())
+        )
+        path = os.path.join(self.config_dir, "userlist.txt")
+        if utils.write_config_file(path, content):
+            self.config_changed = True
+        pw = pwd.getpwnam(self.get_system_user())
+        os.chown(path, 0, pw[3])
+        os.chmod(path, 0o640)
+
+    def post_run(self):
+        """Additional tasks."""
+        self.install_userlist()
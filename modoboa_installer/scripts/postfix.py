@@ -7,6 +7,7 @@ except ImportError:
 import os
 
 from .. import package
+from .. import tuning
 from .. import utils
 
 from . import base
@@ -21,6 +22,7 @@ class Postfix(base.Installer):
         "deb": ["postfix", "postfix-pcre"],
     }
     config_files = ["main.cf", "master.cf", "anonymize_headers.pcre"]
+    use_db_pooler = True
 
     def get_packages(self):
         """Additional packages."""
@@ -30,7 +32,15 @@ class Postfix(base.Installer):
             packages = []
         return super().get_packages() + packages
 
-    def install_packages(self):
+    def get_extra_apps(self):
+        """Postwhite is only used with amavis."""
+        condition = (
+            not self.config.getboolean("rspamd", "enabled") and
+            self.config.getboolean("postwhite", "enabled")
+            )
+        return ["postwhite"] if condition else []
+
+    def prepare_packages(self):
         """Preconfigure postfix package installation."""
         if "centos" in utils.dist_name():
             config = configparser.ConfigParser()
@@ -45,7 +55,6 @@ class Postfix(base.Installer):
 
         package.backend.preconfigure(
             "postfix", "main_mailer_type", "select", "No configuration")
-        super().install_packages()
 
     def get_template_context(self):
         """Additional variables."""
@@ -63,6 +72,17 @@ class Postfix(base.Installer):
             "rspamd_disabled": "" if not self.config.getboolean(
                 "rspamd", "enabled") else "#"
         })
+        settings = tuning.get_postfix_settings(self.config)
+        context.update({
+            "postfix_{}".format(name): value
+            for name, value in settings.items()
+        })
+        if self.config.getboolean("amavis", "enabled"):
+            # smtpd processes hand messages to amavis
+            plan = tuning.get_amavis_plan(self.config)
+            context["smtpd_maxproc"] = plan["smtpd_maxproc"]
+        else:
+            context["smtpd_maxproc"] = "-"
         return context
 
     def check_dhe_group_file(self):
@@ -82,6 +102,13 @@ class Postfix(base.Installer):
             "{} {} generate_postfix_maps --destdir {} --force-overwrite"
             .format(python_path, script_path, self.config_dir))
         utils.exec_cmd(cmd)
+        if self.db_pooled:
+            # Maps are generated from modoboa's settings, which point
+            # to the database server
+            pattern = "s/^hosts\\s*=.*$/hosts = {}:{}/".format(
+                self.dbhost, self.dbport)
+            utils.exec_cmd("perl -pi -e '{}' {}".format(
+                pattern, os.path.join(self.config_dir, "sql-*.cf")))
 
         # Check chroot directory
         chroot_dir = "/var/spool/postfix/etc"
@@ -101,13 +128,8 @@ class Postfix(base.Installer):
         if os.path.exists(aliases_file):
             utils.exec_cmd("postalias {}".format(aliases_file))
 
-        # Postwhite
-        condition = (
-            not self.config.getboolean("rspamd", "enabled") and
-            self.config.getboolean("postwhite", "enabled")
-            )
-        if condition:
-            install("postwhite", self.config, self.upgrade, self.archive_path)
+        for appname in self.get_extra_apps():
+            install(appname, self.config, self.upgrade, self.archive_path)
 
     def backup(self, path):
         """Launch postwhite backup."""
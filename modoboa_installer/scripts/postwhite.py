@@ -41,6 +41,13 @@ class Postwhite(base.Installer):
         os.unlink(target)
         return archive_dir
 
+    def get_plan_commands(self):
+        """Tools are downloaded and whitelists generated."""
+        return [
+            ("post_run", "wget {}/archive/master.zip".format(repository))
+            for repository in [SPF_TOOLS_REPOSITORY, POSTWHITE_REPOSITORY]
+        ] + [("post_run", "postwhite /etc/postwhite.conf")]
+
     def post_run(self):
         """Additionnal tasks."""
         install_dir = "/usr/local/bin"
@@ -31,11 +31,16 @@ class Radicale(base.Installer):
 
     def _setup_venv(self):
         """Prepare a dedicated virtualenv."""
-        python.setup_virtualenv(self.venv_path, sudo_user=self.user)
         packages = [
             "Radicale", "pytz", "radicale-modoboa-auth-oauth2"
         ]
-        python.install_packages(packages, self.venv_path, sudo_user=self.user)
+        python.setup_virtualenv(self.venv_path, sudo_user=self.user)
+        wheelhouse = python.get_wheelhouse(
+            self.config, "radicale", "latest", self.venv_path, self.user)
+        python.install_packages(
+            packages, self.venv_path, sudo_user=self.user,
+            # Unpinned: refresh wheels to get new releases
+            wheelhouse=wheelhouse, refresh=True)
 
     def get_template_context(self):
         """Additional variables."""
@@ -56,6 +61,11 @@ class Radicale(base.Installer):
         })
         return context
 
+    def get_plan_commands(self):
+        """Virtualenv setup."""
+        return [("setup_user", "{} install".format(
+            python.get_pip_path(self.venv_path)))]
+
     def get_config_files(self):
         """Return appropriate path."""
         config_files = super().get_config_files()
@@ -85,7 +95,9 @@ class Radicale(base.Installer):
             restore_target = os.path.join(self.home_dir, "collections")
             if os.path.isdir(restore_target):
                 shutil.rmtree(restore_target)
-            shutil.copytree(radicale_backup, restore_target)
+            utils.copy_tree(
+                radicale_backup, restore_target,
+                workers=utils.get_copy_workers(self.config))
             utils.success("Radicale collections restored from backup")
 
     def post_run(self):
@@ -103,6 +115,7 @@ class Radicale(base.Installer):
         radicale_backup = os.path.join(self.config.get(
             "radicale", "home_dir", fallback="/srv/radicale"), "collections")
         if os.path.isdir(radicale_backup):
-            shutil.copytree(radicale_backup, os.path.join(
-                path, "radicale"))
+            utils.copy_tree(
+                radicale_backup, os.path.join(path, "radicale"),
+                workers=utils.get_copy_workers(self.config))
             utils.printcolor("Radicale files saved", utils.GREEN)
@@ -1,5 +1,6 @@
 import os
 import sys
+from .. import database
 from .. import utils
 
 
@@ -17,10 +18,11 @@ class Restore:
                 "Provided path is not a directory !")
             sys.exit(1)
 
-        modoba_sql_file = os.path.join(restore, "databases/modoboa.sql")
-        if not os.path.isfile(modoba_sql_file):
+        databases_dir = os.path.join(restore, "databases")
+        if not database.find_dump(databases_dir, "modoboa"):
             utils.error(
-                modoba_sql_file + " not found, please check your backup")
+                os.path.join(databases_dir, "modoboa.sql") +
+                " not found, please check your backup")
             sys.exit(1)
 
         # Everything seems alright here, proceeding...
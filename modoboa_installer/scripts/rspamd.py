@@ -5,12 +5,16 @@ import pwd
 import stat
 
 from .. import package
+from .. import tuning
 from .. import utils
 from .. import system
 
 from . import base
 from . import install
 
+# clamd TCP socket used when no remote server is configured
+CLAMD_LOCAL_SERVER = "127.0.0.1:3310"
+
 
 class Rspamd(base.Installer):
     """Rspamd installer."""
@@ -21,6 +25,7 @@ class Rspamd(base.Installer):
             "rspamd", "redis"
         ]
     }
+    extra_apps = ["clamav"]
     config_files = [
         "local.d/arc.conf",
         "local.d/dkim_signing.conf",
@@ -49,7 +54,14 @@ class Rspamd(base.Installer):
         """Return appropriate config dir."""
         return "/etc/rspamd"
 
-    def install_packages(self):
+    def get_extra_apps(self):
+        """clamd is not installed when scanning is done remotely."""
+        if self.config.get("clamav", "servers", fallback=""):
+            return []
+        return super().get_extra_apps()
+
+    def prepare_packages(self):
+        """Add rspamd repository."""
         debian_based_dist, codename = utils.is_dist_debian_based()
         if debian_based_dist:
             utils.mkdir_safe(
@@ -67,8 +79,6 @@ class Rspamd(base.Installer):
             )
             package.backend.update()
 
-        return super().install_packages()
-
     def install_config_files(self):
         """Make sure config directory exists."""
         user = self.config.get(self.appname, "user")
@@ -88,7 +98,7 @@ class Rspamd(base.Installer):
 
     def get_config_files(self):
         """Return appropriate config files."""
-        _config_files = self.config_files
+        _config_files = super().get_config_files()
         if self.config.getboolean("clamav", "enabled"):
             _config_files.append("local.d/antivirus.conf")
         if self.app_config["dnsbl"].lower() == "true":
@@ -103,6 +113,9 @@ class Rspamd(base.Installer):
         _context = super().get_template_context()
         _context["greylisting_disabled"] = "" if not self.app_config["greylisting"].lower() == "true" else "#"
         _context["whitelist_auth_enabled"] = "" if self.app_config["whitelist_auth"].lower() == "true" else "#"
+        _context.update(tuning.get_rspamd_settings(self.config))
+        _context["clamav_servers"] = self.config.get(
+            "clamav", "servers", fallback="") or CLAMD_LOCAL_SERVER
         if self.generate_password_condition:
             code, controller_password = utils.exec_cmd(
                 r"rspamadm pw -p {}".format(self.app_config["password"]))
@@ -124,8 +137,8 @@ class Rspamd(base.Installer):
             self.config.get("modoboa", "user"),
             user
         )
-        if self.config.getboolean("clamav", "enabled"):
-            install("clamav", self.config, self.upgrade, self.archive_path)
+        for appname in self.get_extra_apps():
+            install(appname, self.config, self.upgrade, self.archive_path)
 
     def custom_backup(self, path):
         """Backup custom configuration if any."""
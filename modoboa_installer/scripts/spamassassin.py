@@ -22,6 +22,8 @@ class Spamassassin(base.Installer):
     }
     with_db = True
     config_files = ["v310.pre", "local.cf"]
+    extra_apps = ["razor"]
+    use_db_pooler = True
 
     def get_sql_schema_path(self):
         """Return SQL schema."""
@@ -45,8 +47,8 @@ class Spamassassin(base.Installer):
         context = super(Spamassassin, self).get_template_context()
         if self.dbengine == "postgres":
             store_module = "Mail::SpamAssassin::BayesStore::PgSQL"
-            dsn = "DBI:Pg:dbname={};host={};port={}".format(
-                self.dbname, self.dbhost, self.dbport)
+            dsn = "DBI:{}:dbname={};host={};port={}".format(
+                self.get_dbi_driver(), self.dbname, self.dbhost, self.dbport)
         else:
             store_module = "Mail::SpamAssassin::BayesStore::MySQL"
             dsn = "DBI:mysql:{}:{}:{}".format(
@@ -57,7 +59,8 @@ class Spamassassin(base.Installer):
 
     def post_run(self):
         """Additional tasks."""
-        install("razor", self.config, self.upgrade, self.restore)
+        for appname in self.get_extra_apps():
+            install(appname, self.config, self.upgrade, self.archive_path)
         if utils.dist_name() in ["debian", "ubuntu"]:
             utils.exec_cmd(
                 "perl -pi -e 's/^CRON=0/CRON=1/' /etc/cron.daily/spamassassin")
@@ -4,8 +4,10 @@ import os
 import pwd
 import stat
 
+from .. import constants
 from .. import package
 from .. import system
+from .. import tuning
 from .. import utils
 
 from . import base
@@ -38,9 +40,23 @@ class Uwsgi(base.Installer):
             "app_venv_path": self.config.get(app, "venv_path"),
             "app_instance_path": (
                 self.config.get(app, "instance_path")),
+            "app_reload_file": os.path.join(
+                self.config.get(app, "home_dir"),
+                constants.UWSGI_RELOAD_FILE),
             "uwsgi_socket_path": self.get_socket_path(app),
             "uwsgi_plugin": uwsgi_plugin,
         })
+        topology = tuning.get_uwsgi_topology(self.config)
+        context.update({
+            "nb_processes": topology["processes"],
+            "nb_threads": topology["threads"],
+            "harakiri": topology["harakiri"],
+            "uwsgi_listen": topology["listen"],
+            "uwsgi_cheaper_enabled": "" if topology["cheaper"] else "#",
+            "uwsgi_cheaper": topology["cheaper"],
+            "uwsgi_cheaper_initial": topology["cheaper_initial"],
+            "uwsgi_cheaper_step": topology["cheaper_step"],
+        })
         return context
 
     def get_config_dir(self):
@@ -63,7 +79,8 @@ class Uwsgi(base.Installer):
         src = self.get_file_path("{}.ini.tpl".format(app))
         dst = os.path.join(
             self.get_config_dir(), "{}_instance.ini".format(app))
-        utils.copy_from_template(src, dst, context)
+        if utils.copy_from_template(src, dst, context):
+            self.config_changed = True
         return dst
 
     def _setup_modoboa_config(self):
@@ -99,6 +116,7 @@ class Uwsgi(base.Installer):
                 pw[2], pw[3]
             )
         code, output = utils.exec_cmd("service uwsgi status")
-        action = "start" if code else "restart"
-        utils.exec_cmd("service uwsgi {}".format(action))
+        if code or self.needs_restart():
+            action = "start" if code else "restart"
+            utils.exec_cmd("service uwsgi {}".format(action))
         system.enable_service(self.get_daemon_name())
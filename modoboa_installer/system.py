@@ -3,9 +3,14 @@
 import grp
 import pwd
 import sys
+import threading
 
 from . import utils
 
+# useradd/usermod refuse to run while another instance holds the
+# passwd/group database lock.
+_ACCOUNTS_LOCK = threading.Lock()
+
 
 def create_user(name, home=None):
     """Create a new system user."""
@@ -26,7 +31,8 @@ def create_user(name, home=None):
     cmd = "useradd -m "
     if home:
         cmd += "-d {} ".format(home)
-    utils.exec_cmd("{} {}".format(cmd, name))
+    with _ACCOUNTS_LOCK:
+        utils.exec_cmd("{} {}".format(cmd, name))
     if home:
         utils.exec_cmd("chmod 755 {}".format(home))
 
@@ -43,7 +49,8 @@ def add_user_to_group(user, group):
     except KeyError:
         print("Group {} does not exist".format(group))
         sys.exit(1)
-    utils.exec_cmd("usermod -a -G {} {}".format(group, user))
+    with _ACCOUNTS_LOCK:
+        utils.exec_cmd("usermod -a -G {} {}".format(group, user))
 
 
 def enable_service(name):
@@ -51,10 +58,15 @@ def enable_service(name):
     utils.exec_cmd("systemctl enable {}".format(name))
 
 
-def enable_and_start_service(name):
-    """Enable a start a service."""
+def enable_and_start_service(name, restart=True):
+    """Enable a start a service.
+
+    A running service is restarted only if restart is True.
+    """
     enable_service(name)
     code, output = utils.exec_cmd("service {} status".format(name))
+    if not code and not restart:
+        return
     action = "start" if code else "restart"
     utils.exec_cmd("service {} {}".format(name, action))
 
@@ -0,0 +1,127 @@
+"""Timing of installation steps.
+
+Steps (installer phases and shell commands) are recorded once
+:func:`enable` has been called. The report uses the Chrome trace event
+format, which can be loaded in chrome://tracing, Perfetto or
+speedscope to get a flame graph of the installation.
+"""
+
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+
+# Number of steps displayed by default in summaries
+SUMMARY_SIZE = 10
+# Maximum length of a step name
+NAME_MAX_LENGTH = 100
+
+_EVENTS = []
+_LOCK = threading.Lock()
+_STATE = {"enabled": False, "start": None}
+# Hide passwords passed on command lines (mysql -pXXX, rspamadm pw -p XXX)
+_PASSWORD_RE = re.compile(r"(\s(?:-p|--password)(?:=|\s+)?)\S+")
+
+
+def enable():
+    """Start recording steps."""
+    _STATE["enabled"] = True
+    _STATE["start"] = time.perf_counter()
+
+
+def is_enabled():
+    """Tell if steps are recorded."""
+    return _STATE["enabled"]
+
+
+def command_name(cmd):
+    """Return a printable name for a shell command.
+
+    Only the first line is kept (here-documents may contain secrets)
+    and passwords are masked.
+    """
+    name = _PASSWORD_RE.sub(r"\1***", cmd.splitlines()[0] if cmd else "")
+    if len(name) > NAME_MAX_LENGTH:
+        name = name[:NAME_MAX_LENGTH - 3] + "..."
+    return name
+
+
+@contextlib.contextmanager
+def step(name, category, **args):
+    """Record the duration of the enclosed block.
+
+    The yielded dictionary can be used to attach extra information
+    (exit code for example) to the step.
+    """
+    if not _STATE["enabled"]:
+        yield args
+        return
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        end = time.perf_counter()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int((start - _STATE["start"]) * 1000000),
+            "dur": int((end - start) * 1000000),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with _LOCK:
+            _EVENTS.append(event)
+
+
+def get_slowest(count=SUMMARY_SIZE, category=None):
+    """Return the slowest recorded steps, as (seconds, name) tuples."""
+    with _LOCK:
+        events = [
+            event for event in _EVENTS
+            if category is None or event["cat"] == category
+        ]
+    events.sort(key=lambda event: event["dur"], reverse=True)
+    return [
+        (event["dur"] / 1000000, event["name"]) for event in events[:count]
+    ]
+
+
+def write_report(path):
+    """Write recorded steps to path."""
+    with _LOCK:
+        events = list(_EVENTS)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as fp:
+        json.dump(
+            {"traceEvents": events, "displayTimeUnit": "ms"}, fp, indent=1)
+
+
+def load_report(path):
+    """Load steps recorded by a previous run."""
+    with open(path) as fp:
+        return json.load(fp)["traceEvents"]
+
+
+def estimate(events, phase=None, command=None):
+    """Estimate the duration of a step from recorded events.
+
+    Phases are matched by name, commands by substring (recorded names
+    include sudo prefixes and options). Durations of all matching
+    events are summed.
+
+    :return: a duration in seconds, None if nothing matched
+    """
+    durations = [
+        event["dur"] for event in events
+        if (phase is not None and event["cat"] == "phase" and
+            event["name"] == phase) or
+        (command is not None and event["cat"] == "command" and
+         command in event["name"])
+    ]
+    if not durations:
+        return None
+    return sum(durations) / 1000000
@@ -0,0 +1,600 @@
+"""Sizing of services from host resources.
+
+Values are computed from the number of CPUs and the amount of RAM
+available on the host. Each option can still be forced from the
+configuration file: only ``auto`` values are computed.
+"""
+
+import functools
+import math
+import os
+
+from . import utils
+
+MEBIBYTE = 1024 * 1024
+
+# Used when /proc cannot be read
+DEFAULT_MEMORY_SIZE = 2048 * MEBIBYTE
+DEFAULT_SOMAXCONN = 128
+
+# Share of RAM given to uWSGI workers (the rest of the mail stack
+# needs memory too)
+UWSGI_MEMORY_RATIO = 0.25
+# Approximate resident size of a Modoboa worker process
+UWSGI_PROCESS_MEMORY = 128 * MEBIBYTE
+UWSGI_MIN_PROCESSES = 2
+UWSGI_MAX_THREADS = 8
+UWSGI_DEFAULT_THREADS = 2
+# Minimum uWSGI listen queue (uWSGI default)
+UWSGI_MIN_LISTEN = 100
+# Requests queued per worker slot before connections are refused
+UWSGI_LISTEN_PER_SLOT = 16
+# Timeout (in seconds) on a host with 4 CPUs or more
+UWSGI_BASE_HARAKIRI = 120
+UWSGI_MAX_HARAKIRI = 600
+
+# Postfix settings per profile. proxymap processes each keep one
+# connection per SQL map open, so their number is kept low.
+POSTFIX_PROFILES = {
+    "small": {
+        "default_process_limit": 50,
+        "smtpd_client_connection_count_limit": 10,
+        "smtp_destination_concurrency_limit": 10,
+        "lmtp_destination_concurrency_limit": 5,
+        "proxymap_process_limit": 4,
+        "queue_run_delay": "300s",
+        "minimal_backoff_time": "300s",
+        "maximal_backoff_time": "4000s",
+    },
+    "medium": {
+        "default_process_limit": 100,
+        "smtpd_client_connection_count_limit": 20,
+        "smtp_destination_concurrency_limit": 20,
+        "lmtp_destination_concurrency_limit": 10,
+        "proxymap_process_limit": 8,
+        "queue_run_delay": "300s",
+        "minimal_backoff_time": "300s",
+        "maximal_backoff_time": "4000s",
+    },
+    "high-volume": {
+        "default_process_limit": 300,
+        "smtpd_client_connection_count_limit": 50,
+        "smtp_destination_concurrency_limit": 40,
+        "lmtp_destination_concurrency_limit": 20,
+        "proxymap_process_limit": 16,
+        "queue_run_delay": "180s",
+        "minimal_backoff_time": "180s",
+        "maximal_backoff_time": "3600s",
+    },
+}
+
+# Dovecot login processes serve this many clients per CPU
+DOVECOT_CLIENTS_PER_CPU = 1000
+DOVECOT_MAX_CLIENT_LIMIT = 10000
+
+# Database connections opened by each component. Django keeps one
+# connection per uWSGI thread; background connections cover the
+# policy daemon, RQ workers and cron jobs.
+MODOBOA_BACKGROUND_CONNECTIONS = 10
+# Each proxymap process keeps one connection per SQL map
+POSTFIX_SQL_MAPS = 9
+# auth-worker processes (30 by default) and the dict service
+DOVECOT_SQL_CONNECTIONS = 35
+OPENDKIM_SQL_CONNECTIONS = 5
+# Margin applied to the connection demand (administration tools,
+# upgrades, backups)
+DATABASE_CONNECTION_MARGIN = 1.2
+POSTGRES_MIN_CONNECTIONS = 100
+# Share of RAM used by PostgreSQL shared buffers (the rest of the mail
+# stack runs on the same host)
+POSTGRES_SHARED_BUFFERS_RATIO = 0.125
+POSTGRES_MAX_SHARED_BUFFERS = 8192 * MEBIBYTE
+# First PostgreSQL major version supporting each setting
+POSTGRES_MIN_VERSIONS = {
+    "max_parallel_workers": 10,
+    "max_parallel_maintenance_workers": 11,
+}
+MYSQL_MIN_CONNECTIONS = 151
+PGBOUNCER_MIN_CLIENT_CONN = 200
+
+# Approximate resident size of an amavis child (SpamAssassin loaded)
+AMAVIS_PROCESS_MEMORY = 96 * MEBIBYTE
+AMAVIS_MEMORY_RATIO = 0.2
+AMAVIS_MIN_SERVERS = 2
+AMAVIS_MAX_SERVERS = 30
+
+# clamd keeps a second copy of the signatures in memory while
+# reloading them concurrently; below this amount of RAM, scanning is
+# paused during reloads instead
+CLAMAV_LOW_MEMORY_THRESHOLD = 4096 * MEBIBYTE
+CLAMAV_RELOAD_MODES = ["concurrent", "low_memory"]
+# Decoded attachments are bigger than their encoded form
+CLAMAV_DECODING_RATIO = 1.4
+CLAMAV_DEFAULT_MESSAGE_SIZE = 11534336
+
+# Concurrent milter connections handled by each rspamd proxy worker
+RSPAMD_CONNECTIONS_PER_WORKER = 100
+# File descriptors used per connection (client, redis, antivirus, DNS)
+RSPAMD_FILES_PER_CONNECTION = 4
+# Share of RAM used by Redis (rspamd statistics, greylisting, fuzzy
+# hashes and modoboa's queues)
+REDIS_MEMORY_RATIO = 0.1
+REDIS_MIN_MEMORY = 64 * MEBIBYTE
+REDIS_MAX_MEMORY = 4096 * MEBIBYTE
+# Only keys with an expiration (greylisting, fuzzy hashes, expiring
+# bayes tokens) are evicted, so modoboa's job queues are kept
+REDIS_DEFAULT_POLICY = "volatile-lru"
+# InnoDB bypasses the OS cache so it gets a larger share than
+# PostgreSQL
+MYSQL_BUFFER_POOL_RATIO = 0.25
+MYSQL_MAX_BUFFER_POOL = 16384 * MEBIBYTE
+
+
+@functools.lru_cache(maxsize=None)
+def get_cpu_count():
+    """Return the number of CPUs the installer can use."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+@functools.lru_cache(maxsize=None)
+def get_memory_size():
+    """Return the total amount of RAM, in bytes."""
+    try:
+        with open("/proc/meminfo") as fp:
+            for line in fp:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return DEFAULT_MEMORY_SIZE
+
+
+@functools.lru_cache(maxsize=None)
+def get_somaxconn():
+    """Return the maximum length of a listen queue allowed by the kernel."""
+    try:
+        with open("/proc/sys/net/core/somaxconn") as fp:
+            return int(fp.read().strip())
+    except (OSError, ValueError):
+        return DEFAULT_SOMAXCONN
+
+
+def _get_int_option(config, section, option, default="auto", minimum=1):
+    """Return an integer option, None if it must be computed.
+
+    :raises FatalError: if the value is not an integer >= minimum
+    """
+    value = config.get(section, option, fallback=default).strip()
+    if value.lower() == "auto":
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        value = None
+    if value is None or value < minimum:
+        raise utils.FatalError(
+            "Invalid value for {} in section {}: expected auto or an "
+            "integer >= {}".format(option, section, minimum))
+    return value
+
+
+def get_uwsgi_topology(config, cpus=None, memory=None, somaxconn=None):
+    """Compute uWSGI worker settings.
+
+    Processes are bounded by CPUs (Modoboa mostly waits for the
+    database, so two per CPU) and by the share of RAM they can use.
+    Threads allow the ``expected_concurrency`` hint to be served
+    without spawning more processes than memory allows. The
+    ``cheaper`` subsystem keeps only part of the workers alive while
+    the server is idle.
+
+    :return: a dictionary
+    """
+    cpus = cpus or get_cpu_count()
+    memory = memory or get_memory_size()
+    somaxconn = somaxconn or get_somaxconn()
+    concurrency = _get_int_option(
+        config, "uwsgi", "expected_concurrency", "0", minimum=0)
+
+    processes = _get_int_option(config, "uwsgi", "nb_processes")
+    if processes is None:
+        by_memory = int(memory * UWSGI_MEMORY_RATIO // UWSGI_PROCESS_MEMORY)
+        processes = max(UWSGI_MIN_PROCESSES, min(cpus * 2, by_memory))
+
+    threads = _get_int_option(config, "uwsgi", "nb_threads")
+    if threads is None:
+        if concurrency:
+            threads = math.ceil(concurrency / processes)
+        else:
+            threads = UWSGI_DEFAULT_THREADS
+        threads = max(1, min(UWSGI_MAX_THREADS, threads))
+
+    result = {
+        "processes": processes,
+        "threads": threads,
+        "listen": min(
+            somaxconn,
+            max(UWSGI_MIN_LISTEN,
+                processes * threads * UWSGI_LISTEN_PER_SLOT)
+        ),
+        "cheaper": 0,
+        "cheaper_initial": 0,
+        "cheaper_step": 1,
+    }
+    # 0 disables harakiri
+    harakiri = _get_int_option(config, "uwsgi", "harakiri", minimum=0)
+    if harakiri is None:
+        harakiri = min(
+            UWSGI_MAX_HARAKIRI,
+            UWSGI_BASE_HARAKIRI * max(1, 4 // cpus)
+        )
+    result["harakiri"] = harakiri
+    if processes > 2:
+        # cheaper must stay lower than processes
+        result["cheaper"] = max(1, processes // 4)
+        result["cheaper_initial"] = max(
+            result["cheaper"], math.ceil(processes / 2))
+        result["cheaper_step"] = max(1, processes // 8)
+    return result
+
+
+def get_postfix_profile(config, cpus=None, memory=None):
+    """Return the name of the postfix profile to use."""
+    profile = config.get("postfix", "profile", fallback="auto").strip()
+    if profile != "auto":
+        if profile not in POSTFIX_PROFILES:
+            raise utils.FatalError(
+                "Unknown postfix profile '{}' (valid values: auto, {})"
+                .format(profile, ", ".join(POSTFIX_PROFILES)))
+        return profile
+    cpus = cpus or get_cpu_count()
+    memory = memory or get_memory_size()
+    if cpus < 2 or memory < 2048 * MEBIBYTE:
+        return "small"
+    if cpus >= 8 and memory >= 16384 * MEBIBYTE:
+        return "high-volume"
+    return "medium"
+
+
+def get_postfix_settings(config, cpus=None, memory=None):
+    """Return postfix concurrency settings.
+
+    :return: a dictionary
+    """
+    profile = get_postfix_profile(config, cpus, memory)
+    result = dict(POSTFIX_PROFILES[profile])
+    result["profile"] = profile
+    return result
+
+
+def get_dovecot_settings(config, cpus=None, memory=None):
+    """Compute dovecot authentication cache and process settings.
+
+    Login processes run in high-performance mode: each of them serves
+    many clients and one is kept per CPU.
+
+    :return: a dictionary
+    """
+    cpus = cpus or get_cpu_count()
+    memory = memory or get_memory_size()
+    large = memory >= 4096 * MEBIBYTE
+
+    def get(option, default):
+        value = config.get("dovecot", option, fallback="auto").strip()
+        return default if value == "auto" else value
+
+    result = {
+        "auth_cache_size": get("auth_cache_size", "64M" if large else "16M"),
+        "auth_cache_ttl": get("auth_cache_ttl", "15 mins"),
+        "auth_cache_negative_ttl": get("auth_cache_negative_ttl", "2 mins"),
+        "vsz_limit": get("vsz_limit", "1G" if large else "512M"),
+        "mail_max_userip_connections": get(
+            "mail_max_userip_connections", "20"),
+    }
+    min_avail = _get_int_option(
+        config, "dovecot", "login_process_min_avail", minimum=0)
+    result["login_process_min_avail"] = (
+        cpus if min_avail is None else min_avail)
+    client_limit = _get_int_option(
+        config, "dovecot", "default_client_limit")
+    if client_limit is None:
+        client_limit = min(
+            DOVECOT_MAX_CLIENT_LIMIT, cpus * DOVECOT_CLIENTS_PER_CPU)
+    result["default_client_limit"] = client_limit
+    return result
+
+
+def _is_enabled(config, section):
+    return config.getboolean(section, "enabled", fallback=False)
+
+
+def get_connection_demands(config):
+    """Return the number of database connections needed per component.
+
+    :return: a dictionary
+    """
+    # Modoboa is always installed (and has no enabled option)
+    topology = get_uwsgi_topology(config)
+    result = {
+        "modoboa": (
+            topology["processes"] * topology["threads"] +
+            MODOBOA_BACKGROUND_CONNECTIONS
+        ),
+    }
+    if _is_enabled(config, "postfix"):
+        settings = get_postfix_settings(config)
+        result["postfix"] = (
+            settings["proxymap_process_limit"] * POSTFIX_SQL_MAPS)
+    if _is_enabled(config, "dovecot"):
+        result["dovecot"] = DOVECOT_SQL_CONNECTIONS
+    if _is_enabled(config, "amavis"):
+        result["amavis"] = get_amavis_plan(config)["max_servers"]
+    if _is_enabled(config, "opendkim"):
+        result["opendkim"] = OPENDKIM_SQL_CONNECTIONS
+    return result
+
+
+def get_connection_demand(config):
+    """Return the number of database connections needed by components."""
+    return sum(get_connection_demands(config).values())
+
+
+def _format_size(size):
+    """Format a size (in bytes) using PostgreSQL and MySQL units."""
+    return "{}MB".format(max(1, size // MEBIBYTE))
+
+
+def _get_max_connections(config, minimum):
+    """Return the connection limit of a database server."""
+    demand = get_connection_demand(config) * DATABASE_CONNECTION_MARGIN
+    return max(minimum, math.ceil(demand / 10) * 10)
+
+
+def get_postgres_settings(config, cpus=None, memory=None, version=None):
+    """Compute PostgreSQL server settings.
+
+    Settings unknown to the server prevent it from starting, so they
+    are only returned when its major version (if given) supports them.
+
+    :return: a dictionary
+    """
+    cpus = cpus or get_cpu_count()
+    memory = memory or get_memory_size()
+    max_connections = _get_max_connections(config, POSTGRES_MIN_CONNECTIONS)
+    shared_buffers = min(
+        POSTGRES_MAX_SHARED_BUFFERS,
+        max(128 * MEBIBYTE, int(memory * POSTGRES_SHARED_BUFFERS_RATIO))
+    )
+    # Sorts and hashes may use several work_mem at once per connection
+    work_mem = min(
+        64 * MEBIBYTE,
+        max(4 * MEBIBYTE,
+            (memory - shared_buffers) // (max_connections * 4))
+    )
+    parallel_workers = min(4, cpus // 2)
+    settings = {
+        "max_connections": max_connections,
+        "shared_buffers": _format_size(shared_buffers),
+        "effective_cache_size": _format_size(memory // 2),
+        "maintenance_work_mem": _format_size(
+            min(1024 * MEBIBYTE, memory // 16)),
+        "work_mem": _format_size(work_mem),
+        "wal_buffers": "16MB",
+        "min_wal_size": "512MB",
+        "max_wal_size": "2GB",
+        "checkpoint_completion_target": "0.9",
+        "max_worker_processes": max(8, cpus),
+        "max_parallel_workers": cpus,
+        "max_parallel_workers_per_gather": parallel_workers,
+        "max_parallel_maintenance_workers": parallel_workers,
+    }
+    if version is not None:
+        for name, min_version in POSTGRES_MIN_VERSIONS.items():
+            if version < min_version:
+                del settings[name]
+    return settings
+
+
+def get_mysql_settings(config, memory=None):
+    """Compute MariaDB server settings.
+
+    :return: a dictionary
+    """
+    memory = memory or get_memory_size()
+    max_connections = _get_max_connections(config, MYSQL_MIN_CONNECTIONS)
+    buffer_pool_size = min(
+        MYSQL_MAX_BUFFER_POOL,
+        max(128 * MEBIBYTE, int(memory * MYSQL_BUFFER_POOL_RATIO))
+    )
+    return {
+        "max_connections": max_connections,
+        "innodb_buffer_pool_size": _format_size(buffer_pool_size),
+        "innodb_log_file_size": _format_size(
+            min(2048 * MEBIBYTE, max(48 * MEBIBYTE, buffer_pool_size // 4))),
+        "thread_cache_size": min(256, max(16, max_connections // 4)),
+        "table_open_cache": min(8000, max(2000, max_connections * 8)),
+    }
+
+
+def get_pgbouncer_settings(config, cpus=None):
+    """Compute PgBouncer pool sizes.
+
+    Server connections per pool follow CPUs (more active connections
+    than that only queue up inside PostgreSQL), while clients can open
+    as many connections as components need.
+
+    :return: a dictionary
+    """
+    cpus = cpus or get_cpu_count()
+    pool_size = _get_int_option(config, "pgbouncer", "default_pool_size")
+    if pool_size is None:
+        pool_size = max(5, cpus * 2)
+    max_client_conn = _get_int_option(config, "pgbouncer", "max_client_conn")
+    if max_client_conn is None:
+        max_client_conn = max(
+            PGBOUNCER_MIN_CLIENT_CONN, get_connection_demand(config) * 2)
+    return {
+        "default_pool_size": pool_size,
+        "max_client_conn": max_client_conn,
+    }
+
+
+def get_rspamd_settings(config, cpus=None):
+    """Compute rspamd worker settings.
+
+    :return: a dictionary
+    """
+    cpus = cpus or get_cpu_count()
+    count = _get_int_option(config, "rspamd", "worker_count")
+    if count is None:
+        count = cpus
+    max_conn = _get_int_option(config, "rspamd", "proxy_max_conn")
+    if max_conn is None:
+        max_conn = count * RSPAMD_CONNECTIONS_PER_WORKER
+    return {
+        "worker_count": count,
+        "proxy_max_conn": max_conn,
+        "proxy_max_files": max_conn * RSPAMD_FILES_PER_CONNECTION,
+    }
+
+
+def get_redis_settings(config, memory=None):
+    """Compute Redis memory settings.
+
+    :return: a dictionary
+    """
+    maxmemory = config.get(
+        "rspamd", "redis_maxmemory", fallback="auto").strip()
+    if maxmemory == "auto":
+        memory = memory or get_memory_size()
+        maxmemory = "{}mb".format(min(
+            REDIS_MAX_MEMORY,
+            max(REDIS_MIN_MEMORY, int(memory * REDIS_MEMORY_RATIO))
+        ) // MEBIBYTE)
+    return {
+        "maxmemory": maxmemory,
+        "maxmemory-policy": config.get(
+            "rspamd", "redis_maxmemory_policy",
+            fallback=REDIS_DEFAULT_POLICY).strip(),
+    }
+
+
+def validate_amavis_plan(plan):
+    """Check that concurrency settings are consistent.
+
+    :raises FatalError: if they are not
+    """
+    errors = []
+    if plan["max_servers"] < AMAVIS_MIN_SERVERS:
+        errors.append("amavis needs at least {} processes".format(
+            AMAVIS_MIN_SERVERS))
+    if plan["smtpd_maxproc"] < plan["max_servers"]:
+        errors.append(
+            "postfix smtpd maxproc ({}) is lower than amavis max_servers "
+            "({})".format(plan["smtpd_maxproc"], plan["max_servers"]))
+    if plan["clamd_max_threads"] < plan["max_servers"]:
+        errors.append(
+            "clamd MaxThreads ({}) is lower than amavis max_servers ({})"
+            .format(plan["clamd_max_threads"], plan["max_servers"]))
+    if errors:
+        raise utils.FatalError(
+            "Inconsistent amavis concurrency: {}".format("; ".join(errors)))
+
+
+def get_amavis_plan(config, cpus=None, memory=None):
+    """Compute a concurrency plan shared by postfix, amavis and clamd.
+
+    Postfix hands messages to amavis from its smtpd processes
+    (smtpd_proxy_filter, once the whole message is received), so there
+    must be enough smtpd processes to keep amavis busy; clients beyond
+    max_servers wait in amavis' listen queue. Submission is not
+    filtered inline and keeps postfix defaults. Each amavis process
+    may need a clamd thread.
+
+    :return: a dictionary
+    """
+    max_servers = _get_int_option(config, "amavis", "max_servers")
+    if max_servers is None:
+        cpus = cpus or get_cpu_count()
+        memory = memory or get_memory_size()
+        by_memory = int(
+            memory * AMAVIS_MEMORY_RATIO // AMAVIS_PROCESS_MEMORY)
+        max_servers = max(
+            AMAVIS_MIN_SERVERS,
+            min(cpus * 2, by_memory, AMAVIS_MAX_SERVERS)
+        )
+    postfix_settings = get_postfix_settings(config, cpus, memory)
+    clamd_max_threads = _get_int_option(config, "clamav", "max_threads")
+    plan = {
+        "max_servers": max_servers,
+        "smtpd_maxproc": max(
+            postfix_settings["default_process_limit"], max_servers),
+        "clamd_max_threads": (
+            max_servers if clamd_max_threads is None
+            else clamd_max_threads),
+    }
+    validate_amavis_plan(plan)
+    return plan
+
+
+def _parse_size(value):
+    """Convert a size using K, M or G suffixes to bytes."""
+    units = {"K": 1024, "M": MEBIBYTE, "G": 1024 * MEBIBYTE}
+    size = value.strip().upper()
+    try:
+        if size and size[-1] in units:
+            return int(size[:-1]) * units[size[-1]]
+        return int(size)
+    except ValueError:
+        raise utils.FatalError(
+            "Invalid size '{}' in section clamav".format(value))
+
+
+def get_clamav_settings(config, cpus=None, memory=None):
+    """Compute clamd settings.
+
+    :return: a dictionary of clamd options
+    """
+    if config.getboolean("amavis", "enabled", fallback=False):
+        max_threads = get_amavis_plan(config)["clamd_max_threads"]
+    else:
+        cpus = cpus or get_cpu_count()
+        max_threads = _get_int_option(config, "clamav", "max_threads")
+        if max_threads is None:
+            max_threads = max(4, cpus * 2)
+
+    mode = config.get("clamav", "database_reload", fallback="auto").strip()
+    if mode == "auto":
+        memory = memory or get_memory_size()
+        mode = (
+            "low_memory" if memory < CLAMAV_LOW_MEMORY_THRESHOLD
+            else "concurrent"
+        )
+    elif mode not in CLAMAV_RELOAD_MODES:
+        raise utils.FatalError(
+            "Unknown clamav database_reload value '{}' (valid values: "
+            "auto, {})".format(mode, ", ".join(CLAMAV_RELOAD_MODES)))
+
+    max_file_size = config.get(
+        "clamav", "max_file_size", fallback="auto").strip()
+    if max_file_size == "auto":
+        message_size = config.getint(
+            "postfix", "message_size_limit",
+            fallback=CLAMAV_DEFAULT_MESSAGE_SIZE)
+        max_file_size = "{}M".format(math.ceil(
+            message_size * CLAMAV_DECODING_RATIO / MEBIBYTE))
+    max_scan_size = config.get(
+        "clamav", "max_scan_size", fallback="auto").strip()
+    if max_scan_size == "auto":
+        # Archives may contain several files
+        max_scan_size = "{}M".format(math.ceil(
+            _parse_size(max_file_size) * 4 / MEBIBYTE))
+    return {
+        "MaxThreads": max_threads,
+        "MaxFileSize": max_file_size,
+        "MaxScanSize": max_scan_size,
+        "ConcurrentDatabaseReload": "yes" if mode == "concurrent" else "no",
+    }
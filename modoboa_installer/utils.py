@@ -1,10 +1,15 @@
 """Utility functions."""
 
+import collections
+import concurrent.futures
 import configparser
 import contextlib
 import datetime
+import functools
 import getpass
 import glob
+import hashlib
+import json
 import os
 import pwd
 import random
@@ -13,12 +18,35 @@ import stat
 import string
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 from . import config_dict_template
+from . import constants
+from . import timing
 from .compatibility_matrix import APP_INCOMPATIBILITY
 
 
 ENV = {}
+# Per-thread overrides of ENV, see settings()
+_LOCAL = threading.local()
+# Serialize terminal output and prompts between concurrent installers
+OUTPUT_LOCK = threading.RLock()
+# Command output bigger than this is spooled to disk
+OUTPUT_SPOOL_SIZE = 1024 * 1024
+# Number of output lines kept when only errors matter
+ERROR_OUTPUT_LINES = 50
+# Tree copies: default number of threads, bytes per system call and
+# seconds between progress messages
+DEFAULT_COPY_WORKERS = 4
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+COPY_PROGRESS_INTERVAL = 10
+# First line of files created from templates
+TEMPLATE_HEADER = "# This file was automatically installed on {}\n"
+# Compiled templates: path -> (mtime, template, placeholders)
+_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
 BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
 
 
@@ -31,23 +59,40 @@ class FatalError(Exception):
 
 def user_input(message):
     """Ask something to the user."""
-    answer = input(message)
+    with OUTPUT_LOCK:
+        answer = input(get_setting("log_prefix", "") + message)
     return answer
 
 
-def exec_cmd(cmd, sudo_user=None, login=True, **kwargs):
+def get_setting(name, default=None):
+    """Return a setting, thread-local values taking precedence over ENV."""
+    overrides = getattr(_LOCAL, "settings", {})
+    if name in overrides:
+        return overrides[name]
+    return ENV.get(name, default)
+
+
+def exec_cmd(cmd, sudo_user=None, login=True, line_callback=None,
+             tail=None, **kwargs):
     """
     Execute a shell command.
 
     Run a command using the current user. Set :keyword:`sudo_user` if
     you need different privileges.
 
+    Output is streamed to a spooled temporary file (kept in memory up
+    to :data:`OUTPUT_SPOOL_SIZE` bytes) so long outputs don't have to
+    be built in memory. Use :keyword:`tail` when only the end of the
+    output matters (error messages for example).
+
     :param str cmd: the command to execute
     :param str sudo_user: a valid system username
+    :param callable line_callback: function called with each output line
+    :param int tail: only return the last ``tail`` lines of output
     :rtype: tuple
     :return: return code, command output
     """
-    sudo_user = ENV.get("sudo_user", sudo_user)
+    sudo_user = get_setting("sudo_user", sudo_user)
     if sudo_user is not None:
         cmd = "sudo {}-u {} {}".format("-i " if login else "", sudo_user, cmd)
     if "shell" not in kwargs:
@@ -57,20 +102,42 @@ def exec_cmd(cmd, sudo_user=None, login=True, **kwargs):
         capture_output = kwargs.pop("capture_output")
     if capture_output:
         kwargs.update(stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    kwargs["universal_newlines"] = True
-    output: str = ""
-    with subprocess.Popen(cmd, **kwargs) as process:
+    debug = ENV.get("debug")
+    if tail is not None:
+        output = collections.deque(maxlen=tail)
+        store = output.append
+    else:
+        output = tempfile.SpooledTemporaryFile(max_size=OUTPUT_SPOOL_SIZE)
+        store = output.write
+    with timing.step(timing.command_name(cmd), "command") as step, \
+            subprocess.Popen(cmd, **kwargs) as process:
         if capture_output:
             for line in process.stdout:
-                output += line
-                if ENV.get("debug"):
-                    sys.stdout.write(line)
-
-    return process.returncode, output.encode()
-
-
+                store(line)
+                if not debug and line_callback is None:
+                    continue
+                line = line.decode(errors="replace")
+                if debug:
+                    with OUTPUT_LOCK:
+                        sys.stdout.write(get_setting("log_prefix", "") + line)
+                if line_callback is not None:
+                    line_callback(line)
+        process.wait()
+        step["exit_code"] = process.returncode
+
+    if tail is not None:
+        return process.returncode, b"".join(output)
+    with output:
+        output.seek(0)
+        return process.returncode, output.read()
+
+
+@functools.lru_cache(maxsize=None)
 def dist_info():
-    """Try to return information about the system we're running on."""
+    """Try to return information about the system we're running on.
+
+    The result is cached, use ``dist_info.cache_clear()`` to reset it.
+    """
     path = "/etc/os-release"
     if os.path.exists(path):
         info = {}
@@ -94,6 +161,7 @@ def dist_name():
     return dist_info()[0].lower()
 
 
+@functools.lru_cache(maxsize=None)
 def is_dist_debian_based() -> (bool, str):
     """Check if current OS is Debian based or not."""
     status, codename = exec_cmd("lsb_release -c -s")
@@ -130,12 +198,17 @@ def make_password(length=16):
 
 @contextlib.contextmanager
 def settings(**kwargs):
-    """Context manager to declare temporary settings."""
-    for key, value in kwargs.items():
-        ENV[key] = value
-    yield
-    for key in kwargs.keys():
-        del ENV[key]
+    """Context manager to declare temporary settings.
+
+    Settings only apply to the current thread so installers running
+    concurrently do not see each other's values.
+    """
+    previous = getattr(_LOCAL, "settings", {})
+    _LOCAL.settings = dict(previous, **kwargs)
+    try:
+        yield
+    finally:
+        _LOCAL.settings = previous
 
 
 class ConfigFileTemplate(string.Template):
@@ -143,6 +216,51 @@ class ConfigFileTemplate(string.Template):
 
     delimiter = "%"
 
+    def get_placeholders(self):
+        """Return the names used in this template.
+
+        :raises FatalError: if the template contains an invalid placeholder
+        """
+        names = set()
+        for match in self.pattern.finditer(self.template):
+            name = match.group("named") or match.group("braced")
+            if name:
+                names.add(name)
+            elif match.group("invalid") is not None:
+                lineno = self.template.count(
+                    "\n", 0, match.start("invalid")) + 1
+                raise FatalError(
+                    "Invalid placeholder at line {}".format(lineno))
+        return names
+
+
+def get_template(path):
+    """Return a compiled template and its placeholders.
+
+    Templates are read and parsed once, unless they are modified.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _TEMPLATES.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1], cached[2]
+    with open(path) as fp:
+        template = ConfigFileTemplate(fp.read())
+    try:
+        placeholders = template.get_placeholders()
+    except FatalError as inst:
+        raise FatalError("{}: {}".format(path, inst))
+    with _TEMPLATES_LOCK:
+        _TEMPLATES[path] = (mtime, template, placeholders)
+    return template, placeholders
+
+
+def load_templates(root):
+    """Compile all templates (.tpl files) found under root."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fname in filenames:
+            if fname.endswith(".tpl"):
+                get_template(os.path.join(dirpath, fname))
+
 
 def backup_file(fname):
     """Create a backup of a given file."""
@@ -153,27 +271,353 @@ def backup_file(fname):
     shutil.copy(fname, bak_name)
 
 
+def get_content_hash(content):
+    """Return the hash of a file content, template header excluded."""
+    if isinstance(content, str):
+        content = content.encode()
+    prefix = TEMPLATE_HEADER.split("{")[0].encode()
+    if content.startswith(prefix):
+        content = content.split(b"\n", 1)[1] if b"\n" in content else b""
+    return hashlib.sha256(content).hexdigest()
+
+
+def is_file_content(path, content):
+    """Tell if path exists and already contains content."""
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as fp:
+        return get_content_hash(fp.read()) == get_content_hash(content)
+
+
 def copy_file(src, dest):
-    """Copy a file to a destination and make a backup before."""
+    """Copy a file to a destination and make a backup before.
+
+    Nothing is done if destination is already identical.
+
+    :return: True if the destination has been written
+    """
     if os.path.isdir(dest):
         dest = os.path.join(dest, os.path.basename(src))
     if os.path.isfile(dest):
+        with open(src, "rb") as fp:
+            if is_file_content(dest, fp.read()):
+                return False
         backup_file(dest)
     shutil.copy(src, dest)
+    return True
 
 
-def copy_from_template(template, dest, context):
-    """Create and copy a configuration file from a template."""
-    now = datetime.datetime.now().isoformat()
-    with open(template) as fp:
-        buf = fp.read()
+def load_manifest(path):
+    """Load a backup manifest, return None if it can't be read."""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def find_previous_manifest(root, name, exclude=None):
+    """Return the most recent manifest called name found in root subdirs."""
+    candidates = []
+    for path in glob.glob(os.path.join(root, "*", name)):
+        backup_dir = os.path.dirname(path)
+        if exclude and os.path.realpath(backup_dir) == os.path.realpath(exclude):
+            continue
+        candidates.append(path)
+    if not candidates:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+
+def _copy_file_data(fsrc, fdst):
+    """Copy file content, in kernel space when possible."""
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    copied = 0
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method):
+            continue
+        try:
+            while True:
+                if method == "copy_file_range":
+                    count = os.copy_file_range(infd, outfd, COPY_CHUNK_SIZE)
+                else:
+                    count = os.sendfile(outfd, infd, None, COPY_CHUNK_SIZE)
+                if not count:
+                    return copied
+                copied += count
+        except OSError:
+            if copied:
+                raise
+            # Not supported between these files, try the next method
+    shutil.copyfileobj(fsrc, fdst)
+    return os.fstat(outfd).st_size
+
+
+def fast_copy_file(src, dst, uid=-1, gid=-1):
+    """Copy a file and its metadata (like shutil.copy2).
+
+    Ownership is changed using the open descriptor if uid or gid is
+    given (-1 leaves it unchanged).
+
+    :return: the number of bytes copied
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = _copy_file_data(fsrc, fdst)
+        if uid != -1 or gid != -1:
+            os.fchown(fdst.fileno(), uid, gid)
+    shutil.copystat(src, dst)
+    return size
+
+
+def copy_symlink(src, dst, uid=-1, gid=-1):
+    """Recreate symlink src as dst, replacing an existing file or link."""
+    if os.path.islink(dst) or os.path.isfile(dst):
+        os.unlink(dst)
+    os.symlink(os.readlink(src), dst)
+    if uid != -1 or gid != -1:
+        os.lchown(dst, uid, gid)
+
+
+def get_dump_jobs(config):
+    """Return the number of databases (or tables) dumped concurrently."""
+    return max(1, config.getint("backup", "dump_jobs", fallback=1))
+
+
+def get_copy_workers(config):
+    """Return the number of threads to use when copying trees."""
+    return max(1, config.getint(
+        "backup", "copy_workers", fallback=DEFAULT_COPY_WORKERS))
+
+
+def copy_tree(src, dst, workers=DEFAULT_COPY_WORKERS, link_from=None,
+              files=None, uid=-1, gid=-1):
+    """Copy a directory tree using a pool of threads.
+
+    Directories are created while walking ``src``, files are copied
+    by ``workers`` threads. Progress is displayed regularly.
+
+    :param str src: directory to copy
+    :param str dst: destination directory
+    :param int workers: number of copy threads
+    :param callable link_from: called with the relative path and the
+                               stat result of each file, may return a
+                               file to hard-link instead of copying
+    :param dict files: if given, filled with relative path ->
+                       [size, mtime_ns] entries
+    :param int uid: owner to set on copied entries (-1 to keep root)
+    :param int gid: group to set on copied entries (-1 to keep root)
+    :return: a dictionary of statistics
+    """
+    stats = {"files": 0, "bytes": 0, "linked": 0}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 64)
+    errors = []
+    started = time.monotonic()
+
+    def copy_one(source, target, link_target):
+        try:
+            if link_target:
+                try:
+                    os.link(link_target, target)
+                except OSError:
+                    pass
+                else:
+                    with lock:
+                        stats["linked"] += 1
+                    return
+            size = fast_copy_file(source, target, uid, gid)
+            with lock:
+                stats["files"] += 1
+                stats["bytes"] += size
+        except Exception as inst:
+            errors.append(inst)
+        finally:
+            slots.release()
+
+    def report(final=False):
+        elapsed = max(time.monotonic() - started, 0.001)
+        with lock:
+            message = (
+                "{} files copied, {} linked, {:.1f} MiB in {:.0f}s "
+                "({:.1f} MiB/s)".format(
+                    stats["files"], stats["linked"],
+                    stats["bytes"] / 1048576, elapsed,
+                    stats["bytes"] / 1048576 / elapsed)
+            )
+        printcolor(message, BLUE if final else CYAN)
+
+    change_owner = uid != -1 or gid != -1
+    directories = []
+    last_report = started
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for dirpath, dirnames, filenames in os.walk(src):
+            if errors:
+                # Don't queue more work once a copy has failed
+                break
+            relpath = os.path.relpath(dirpath, src)
+            target_dir = os.path.normpath(os.path.join(dst, relpath))
+            os.makedirs(target_dir, exist_ok=True)
+            if change_owner:
+                os.chown(target_dir, uid, gid)
+            directories.append((dirpath, target_dir))
+            # Symlinks to directories are listed but not followed
+            for dirname in list(dirnames):
+                source = os.path.join(dirpath, dirname)
+                if not os.path.islink(source):
+                    continue
+                dirnames.remove(dirname)
+                copy_symlink(
+                    source, os.path.join(target_dir, dirname), uid, gid)
+            for filename in filenames:
+                if errors:
+                    break
+                source = os.path.join(dirpath, filename)
+                target = os.path.join(target_dir, filename)
+                if os.path.islink(source):
+                    copy_symlink(source, target, uid, gid)
+                    continue
+                key = os.path.normpath(os.path.join(relpath, filename))
+                link_target = None
+                if files is not None or link_from is not None:
+                    st = os.stat(source)
+                    if files is not None:
+                        files[key] = [st.st_size, st.st_mtime_ns]
+                    if link_from is not None:
+                        link_target = link_from(key, st)
+                slots.acquire()
+                pool.submit(copy_one, source, target, link_target)
+                if time.monotonic() - last_report > COPY_PROGRESS_INTERVAL:
+                    report()
+                    last_report = time.monotonic()
+    if errors:
+        raise errors[0]
+    # Copy directory times last since adding files changes them
+    for dirpath, target_dir in reversed(directories):
+        shutil.copystat(dirpath, target_dir)
+    report(final=True)
+    stats["seconds"] = time.monotonic() - started
+    return stats
+
+
+def backup_tree(src, dst, manifest_path, previous_manifest_path=None,
+                workers=DEFAULT_COPY_WORKERS):
+    """Copy a directory tree and record its content in a manifest.
+
+    If the manifest of a previous copy is given, files with the same
+    size and modification time as in this copy are hard-linked to it
+    instead of being copied (maildir files never change once
+    delivered).
+
+    :param str src: directory to copy
+    :param str dst: destination directory (must not exist)
+    :param str manifest_path: where to write the manifest of this copy
+    :param str previous_manifest_path: manifest of a previous copy
+    :param int workers: number of copy threads
+    :return: the manifest
+    """
+    previous = None
+    if previous_manifest_path:
+        previous = load_manifest(previous_manifest_path)
+    previous_files = previous["files"] if previous else {}
+
+    def link_from(key, st):
+        if previous_files.get(key) == [st.st_size, st.st_mtime_ns]:
+            return os.path.join(previous["path"], key)
+        return None
+
+    manifest = {
+        "date": datetime.datetime.now().isoformat(),
+        "source": os.path.abspath(src),
+        "path": os.path.abspath(dst),
+        "reference": previous["path"] if previous else None,
+        "files": {},
+    }
+    stats = copy_tree(
+        src, dst, workers=workers, link_from=link_from,
+        files=manifest["files"])
+    manifest["copied"] = stats["files"]
+    manifest["linked"] = stats["linked"]
+    with open(manifest_path, "w") as fp:
+        json.dump(manifest, fp)
+    return manifest
+
+
+def backup_mailboxes(config, home_dir, backup_path):
+    """Copy mailboxes into the mails/ directory of a backup.
+
+    If incremental mail backups are enabled, unchanged files are
+    hard-linked to the most recent backup found in the default backup
+    directory.
+    """
+    dst = os.path.join(backup_path, "mails")
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    previous = None
+    if config.getboolean("backup", "incremental_mails", fallback=False):
+        root = config.get(
+            "backup", "default_path",
+            fallback=constants.DEFAULT_BACKUP_DIRECTORY)
+        previous = find_previous_manifest(
+            root, constants.MAIL_BACKUP_MANIFEST, exclude=backup_path)
+    manifest = backup_tree(
+        home_dir, dst,
+        os.path.join(backup_path, constants.MAIL_BACKUP_MANIFEST),
+        previous, workers=get_copy_workers(config)
+    )
+    if manifest["reference"]:
+        printcolor(
+            "Unchanged files linked to {}".format(manifest["reference"]),
+            BLUE)
+    return manifest
+
+
+def render_templates(templates):
+    """Create configuration files from templates.
+
+    All templates are checked and rendered before any file is written,
+    so a missing variable doesn't leave a half updated configuration.
+    Destinations are left untouched (no new header, no backup) if
+    their content would not change.
+
+    :param list templates: (template, destination, context) tuples
+    :return: a list of booleans telling which destinations were written
+    :raises FatalError: if a variable is missing from a context
+    """
+    rendered = []
+    for path, dest, context in templates:
+        template, placeholders = get_template(path)
+        missing = sorted(name for name in placeholders if name not in context)
+        if missing:
+            raise FatalError("{}: missing value for {}".format(
+                path, ", ".join(missing)))
+        rendered.append((dest, template.substitute(context)))
+    return [write_config_file(dest, content) for dest, content in rendered]
+
+
+def write_config_file(dest, content):
+    """Write a generated configuration file.
+
+    Nothing is done if destination already has the same content,
+    otherwise a backup is made before it is replaced.
+
+    :return: True if the destination has been written
+    """
     if os.path.isfile(dest):
+        if is_file_content(dest, content):
+            return False
         backup_file(dest)
     with open(dest, "w") as fp:
-        fp.write(
-            "# This file was automatically installed on {}\n"
-            .format(now))
-        fp.write(ConfigFileTemplate(buf).substitute(context))
+        fp.write(TEMPLATE_HEADER.format(datetime.datetime.now().isoformat()))
+        fp.write(content)
+    return True
+
+
+def copy_from_template(template, dest, context):
+    """Create and copy a configuration file from a template.
+
+    :return: True if the destination has been written
+    """
+    return render_templates([(template, dest, context)])[0]
 
 
 def check_config_file(dest,
@@ -230,7 +674,8 @@ def printcolor(message, color):
     """Print a message using a green color."""
     if has_colours:
         message = "\x1b[1;{}m{}\x1b[0m".format(30 + color, message)
-    print(message)
+    with OUTPUT_LOCK:
+        print(get_setting("log_prefix", "") + message)
 
 
 def error(message):
@@ -11,10 +11,12 @@ import sys
 from modoboa_installer import checks
 from modoboa_installer import compatibility_matrix
 from modoboa_installer import constants
+from modoboa_installer import database
 from modoboa_installer import package
 from modoboa_installer import scripts
 from modoboa_installer import ssl
 from modoboa_installer import system
+from modoboa_installer import timing
 from modoboa_installer import utils
 from modoboa_installer import disclaimers
 
@@ -22,6 +24,7 @@ from modoboa_installer import disclaimers
 PRIMARY_APPS = [
     "fail2ban",
     "modoboa",
+    "pgbouncer",
     "radicale",
     "uwsgi",
     "nginx",
@@ -64,11 +67,88 @@ def backup_system(config, args):
     # Backup configuration file
     utils.copy_file(args.configfile, backup_path)
     # Backup applications
+    apps = []
     for app in PRIMARY_APPS:
         if app == "dovecot" and args.no_mail:
             utils.printcolor("Skipping mail backup", utils.BLUE)
             continue
-        scripts.backup(app, config, backup_path)
+        apps.append(app)
+    scripts.backup_many(
+        apps, config, backup_path,
+        jobs=config.getint("backup", "dump_jobs", fallback=1))
+
+
+def profile_report(path):
+    """Write the timing report and display the slowest steps."""
+    timing.write_report(path)
+    for category, title in [("phase", "phases"), ("command", "commands")]:
+        utils.printcolor("Slowest {}:".format(title), utils.BLUE)
+        for duration, name in timing.get_slowest(category=category):
+            utils.printcolor(
+                "  {:>8.1f}s  {}".format(duration, name), utils.BLUE)
+    utils.printcolor(
+        "Timing report written to {}".format(path), utils.BLUE)
+
+
+def prefetch_packages(config, appnames):
+    """Build a local repository containing the required packages."""
+    extra_packages = ["sudo", "wget"]
+    if package.backend.FORMAT == "deb":
+        extra_packages.append("python3-venv")
+        if config.get("certificate", "type") == "letsencrypt":
+            extra_packages += ["certbot", "python3-certbot-nginx"]
+    else:
+        extra_packages.append("python3")
+        if config.get("certificate", "type") == "letsencrypt":
+            extra_packages.append("certbot")
+    scripts.prefetch_packages(appnames, config, extra_packages)
+
+
+def display_plan(config, args, appnames):
+    """Display what the installation would do and how long it may take."""
+    events = []
+    if os.path.isfile(args.plan):
+        events = timing.load_report(args.plan)
+    else:
+        utils.printcolor(
+            "No timing report found at {}, durations can't be estimated "
+            "(see --profile)".format(args.plan), utils.YELLOW)
+    total = 0
+    lines = []
+    global_steps = ["prepare_system"]
+    if config.get("certificate", "type") != "manual" and not args.upgrade:
+        global_steps.append("generate_cert")
+    global_steps.append("install_packages")
+    if config.getboolean("database", "install"):
+        global_steps.append("database.install_package")
+    lines.append(("[global]", None))
+    for name in global_steps:
+        duration = timing.estimate(events, phase=name)
+        total += duration or 0
+        lines.append(("  {}".format(name), duration))
+    for appname, steps in scripts.get_plan(
+            appnames, config, args.upgrade, args.restore):
+        lines.append(("[{}]".format(appname), None))
+        seen_phases = set()
+        for phase, description in steps:
+            duration = timing.estimate(events, command=description)
+            if phase not in seen_phases:
+                seen_phases.add(phase)
+                phase_duration = timing.estimate(
+                    events, phase="{}.{}".format(appname, phase))
+                total += phase_duration or 0
+                if duration is None:
+                    duration = phase_duration
+            lines.append(
+                ("  {:<22}{}".format(phase, description), duration))
+    utils.printcolor("Installation plan:", utils.BLUE)
+    for line, duration in lines:
+        if duration is not None:
+            line = "{:<70} ~{:.1f}s".format(line, duration)
+        utils.printcolor(line, utils.BLUE)
+    if events:
+        utils.printcolor(
+            "Estimated duration: {:.0f}s".format(total), utils.BLUE)
 
 
 def config_file_update_complete(backup_location):
@@ -129,6 +209,24 @@ def parser_setup(input_args):
     parser.add_argument(
         "--skip-checks", action="store_true", default=False,
         help="Skip the checks the installer performs initially")
+    parser.add_argument(
+        "--jobs", type=int, default=1, metavar="N",
+        help="Number of components to install concurrently (default: 1)")
+    parser.add_argument(
+        "--prefetch-packages", action="store_true", default=False,
+        help="Download the system packages required by the installation "
+        "to the local repository defined in the cache section and exit")
+    parser.add_argument(
+        "--plan", nargs="?", const=constants.DEFAULT_PROFILE_REPORT,
+        metavar="path",
+        help="Display what the installation would do and exit. Durations "
+        "are estimated using the report of a previous --profile run "
+        "(default: {})".format(constants.DEFAULT_PROFILE_REPORT))
+    parser.add_argument(
+        "--profile", nargs="?", const=constants.DEFAULT_PROFILE_REPORT,
+        metavar="path",
+        help="Record the duration of each step and write a trace report "
+        "(default: {})".format(constants.DEFAULT_PROFILE_REPORT))
     parser.add_argument("domain", type=str,
                         help="The main domain of your future mail server")
     return parser.parse_args(input_args)
@@ -140,6 +238,8 @@ def main(input_args):
 
     if args.debug:
         utils.ENV["debug"] = True
+    if args.profile:
+        timing.enable()
 
     # Restore prep
     is_restoring = False
@@ -204,6 +304,14 @@ def main(input_args):
         backup_system(config, args)
         return
 
+    if args.prefetch_packages:
+        prefetch_packages(config, PRIMARY_APPS + antispam_apps)
+        return
+
+    if args.plan:
+        display_plan(config, args, PRIMARY_APPS + antispam_apps)
+        return
+
     # Display disclaimer python 3 linux distribution
     if args.upgrade:
         disclaimers.upgrade_disclaimer(config)
@@ -217,7 +325,7 @@ def main(input_args):
     components = []
     for section in config.sections():
         if section in ["general", "antispam", "database", "mysql", "postgres",
-                       "certificate", "letsencrypt", "backup"]:
+                       "certificate", "letsencrypt", "backup", "cache"]:
             continue
         if (config.has_option(section, "enabled") and
                 not config.getboolean(section, "enabled")):
@@ -236,15 +344,32 @@ def main(input_args):
         "The process can be long, feel free to take a coffee "
         "and come back later ;)", utils.BLUE)
     utils.success("Starting...")
-    package.backend.prepare_system()
-    package.backend.install_many(["sudo", "wget"])
-    ssl_backend = ssl.get_backend(config)
-    if ssl_backend and not args.upgrade:
-        ssl_backend.generate_cert()
-    for appname in PRIMARY_APPS + antispam_apps:
-        scripts.install(appname, config, args.upgrade, args.restore)
-    system.restart_service("cron")
-    package.backend.restore_system()
+    if config.getboolean("cache", "packages", fallback=False):
+        package.backend.use_local_repository(
+            config.get("cache", "packages_dir"))
+    try:
+        with timing.step("prepare_system", "phase"):
+            package.backend.prepare_system()
+            package.backend.install_many(["sudo", "wget"])
+        ssl_backend = ssl.get_backend(config)
+        if ssl_backend and not args.upgrade:
+            with timing.step("generate_cert", "phase"):
+                ssl_backend.generate_cert()
+        with timing.step("install_packages", "phase"):
+            scripts.install_packages(
+                PRIMARY_APPS + antispam_apps, config, args.upgrade,
+                args.restore)
+        if config.getboolean("database", "install"):
+            with timing.step("database.install_package", "phase"):
+                database.get_backend(config).install_package()
+        scripts.install_many(
+            PRIMARY_APPS + antispam_apps, config, args.upgrade, args.restore,
+            jobs=args.jobs)
+        system.restart_service("cron")
+        package.backend.restore_system()
+    finally:
+        if args.profile:
+            profile_report(args.profile)
     hostname = config.get("general", "hostname")
     if not args.restore:
         utils.success(
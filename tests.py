@@ -19,6 +19,12 @@ except ImportError:
     from mock import patch
 
 import run
+from modoboa_installer import database
+from modoboa_installer import package
+from modoboa_installer import scripts
+from modoboa_installer import timing
+from modoboa_installer import tuning
+from modoboa_installer import utils
 
 
 class ConfigFileTestCase(unittest.TestCase):
@@ -175,5 +181,408 @@ class ConfigFileTestCase(unittest.TestCase):
         )
 
 
+class InstallSchedulerTestCase(unittest.TestCase):
+    """Test concurrent installation scheduling."""
+
+    @patch("sys.stdout", new_callable=StringIO)
+    @patch("modoboa_installer.scripts.install")
+    def test_dependencies_order(self, mock_install, mock_stdout):
+        """Check that dependencies are installed first."""
+        order = []
+        mock_install.side_effect = (
+            lambda appname, *args: order.append(appname))
+        appnames = run.PRIMARY_APPS + ["amavis", "opendkim"]
+        scripts.install_many(appnames, None, False, None, jobs=4)
+        self.assertCountEqual(order, appnames)
+        for appname in order:
+            for dependency in scripts.DEPENDENCIES[appname]:
+                self.assertLess(
+                    order.index(dependency), order.index(appname))
+
+
+    def test_packages_are_not_accumulated(self):
+        """Check that planning packages several times is harmless."""
+        config = utils.load_config_template(False)
+        opendkim = scripts.load_app_script("opendkim").Opendkim(
+            config, False, None)
+        packages = list(opendkim.get_packages())
+        self.assertEqual(opendkim.get_packages(), packages)
+
+
+class ExecCmdTestCase(unittest.TestCase):
+    """Test command execution."""
+
+    def test_output_capture(self):
+        """Check full output, tail mode and line callback."""
+        code, output = utils.exec_cmd("seq 1 5; exit 3")
+        self.assertEqual(code, 3)
+        self.assertEqual(output, b"1\n2\n3\n4\n5\n")
+        lines = []
+        code, output = utils.exec_cmd(
+            "seq 1 5", tail=2, line_callback=lines.append)
+        self.assertEqual(output, b"4\n5\n")
+        self.assertEqual(len(lines), 5)
+
+
+class PackageTestCase(unittest.TestCase):
+    """Test package change detection."""
+
+    @patch.object(package.Package, "load_installed_versions")
+    def test_packages_changed(self, mock_versions):
+        """Check that target releases are ignored."""
+        mock_versions.return_value = {"dovecot-core": "2.3"}
+        backend = package.Package("debian")
+        backend.snapshot_versions()
+        self.assertFalse(backend.packages_changed(
+            ["dovecot-core/bookworm-backports"]))
+        backend.invalidate_cache()
+        mock_versions.return_value = {"dovecot-core": "2.4"}
+        self.assertTrue(backend.packages_changed(
+            ["dovecot-core/bookworm-backports"]))
+
+
+class TimingTestCase(unittest.TestCase):
+    """Test step recording."""
+
+    def test_passwords_are_masked(self):
+        """Check that passwords don't appear in command names."""
+        self.assertEqual(
+            timing.command_name("rspamadm pw -p secret"),
+            "rspamadm pw -p ***")
+        self.assertEqual(
+            timing.command_name("mysqldump -u root -psecret modoboa"),
+            "mysqldump -u root -p*** modoboa")
+        self.assertEqual(
+            timing.command_name("tool --password=secret\nsecret"),
+            "tool --password=***")
+
+
+class BackupTreeTestCase(unittest.TestCase):
+    """Test incremental tree copies."""
+
+    def setUp(self):
+        """Create a source tree."""
+        self.workdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.workdir, "vmail")
+        os.makedirs(os.path.join(self.src, "cur"))
+        for name in ["1", "2"]:
+            with open(os.path.join(self.src, "cur", name), "w") as fp:
+                fp.write(name)
+
+    def tearDown(self):
+        """Delete temp dir."""
+        shutil.rmtree(self.workdir)
+
+    def test_unchanged_files_are_linked(self):
+        """Check that only new files are copied."""
+        manifest1 = os.path.join(self.workdir, "1.json")
+        utils.backup_tree(
+            self.src, os.path.join(self.workdir, "backup1"), manifest1)
+        with open(os.path.join(self.src, "cur", "3"), "w") as fp:
+            fp.write("3")
+        manifest = utils.backup_tree(
+            self.src, os.path.join(self.workdir, "backup2"),
+            os.path.join(self.workdir, "2.json"), manifest1)
+        self.assertEqual(manifest["linked"], 2)
+        self.assertEqual(manifest["copied"], 1)
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.workdir, "backup1", "cur", "1"),
+            os.path.join(self.workdir, "backup2", "cur", "1")))
+
+    def test_symlinks_are_preserved(self):
+        """Check that symlinks to files and directories are recreated."""
+        os.symlink("cur", os.path.join(self.src, "new"))
+        os.symlink("cur/1", os.path.join(self.src, "latest"))
+        dst = os.path.join(self.workdir, "copy")
+        stats = utils.copy_tree(self.src, dst)
+        self.assertEqual(stats["files"], 2)
+        for name, target in [("new", "cur"), ("latest", "cur/1")]:
+            path = os.path.join(dst, name)
+            self.assertTrue(os.path.islink(path))
+            self.assertEqual(os.readlink(path), target)
+        # Restoring over an existing copy
+        utils.copy_tree(self.src, dst)
+        self.assertEqual(os.readlink(os.path.join(dst, "new")), "cur")
+
+    @patch("modoboa_installer.utils.fast_copy_file")
+    def test_copy_stops_on_error(self, mock_copy):
+        """Check that no more files are queued once a copy failed."""
+        mock_copy.side_effect = OSError("disk full")
+        for name in range(500):
+            with open(os.path.join(self.src, str(name)), "w") as fp:
+                fp.write("x")
+        with self.assertRaises(OSError):
+            utils.copy_tree(
+                self.src, os.path.join(self.workdir, "copy"), workers=1)
+        self.assertLess(mock_copy.call_count, 500)
+
+    def test_link_from(self):
+        """Check that files are hard-linked when a target is given."""
+        reference = os.path.join(self.workdir, "reference")
+        shutil.copytree(self.src, reference)
+        seen = []
+
+        def link_from(key, st):
+            seen.append(key)
+            if key == os.path.join("cur", "1"):
+                return os.path.join(reference, key)
+            return None
+
+        dst = os.path.join(self.workdir, "copy")
+        stats = utils.copy_tree(self.src, dst, link_from=link_from)
+        self.assertEqual(sorted(seen), [
+            os.path.join("cur", "1"), os.path.join("cur", "2")])
+        self.assertEqual((stats["linked"], stats["files"]), (1, 1))
+        self.assertTrue(os.path.samefile(
+            os.path.join(reference, "cur", "1"),
+            os.path.join(dst, "cur", "1")))
+        self.assertFalse(os.path.samefile(
+            os.path.join(reference, "cur", "2"),
+            os.path.join(dst, "cur", "2")))
+
+    @unittest.skipUnless(os.geteuid() == 0, "requires root")
+    def test_ownership(self):
+        """Check that copied entries belong to the given user."""
+        os.symlink("cur", os.path.join(self.src, "new"))
+        dst = os.path.join(self.workdir, "copy")
+        utils.copy_tree(self.src, dst, uid=65534, gid=65534)
+        for path in [dst, os.path.join(dst, "cur"),
+                     os.path.join(dst, "cur", "1"), os.path.join(dst, "new")]:
+            st = os.lstat(path)
+            self.assertEqual((st.st_uid, st.st_gid), (65534, 65534))
+
+
+class ConfigTemplateTestCase(unittest.TestCase):
+    """Test configuration file rendering."""
+
+    def test_unchanged_file_is_not_rewritten(self):
+        """Check that identical content is detected."""
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        template = os.path.join(workdir, "test.tpl")
+        dest = os.path.join(workdir, "test.conf")
+        with open(template, "w") as fp:
+            fp.write("value = %value\n")
+        self.assertTrue(
+            utils.copy_from_template(template, dest, {"value": 1}))
+        self.assertFalse(
+            utils.copy_from_template(template, dest, {"value": 1}))
+        self.assertEqual(len(os.listdir(workdir)), 2)
+        self.assertTrue(
+            utils.copy_from_template(template, dest, {"value": 2}))
+        self.assertEqual(len(os.listdir(workdir)), 3)
+        with self.assertRaises(utils.FatalError):
+            utils.copy_from_template(template, dest, {})
+
+
+class DumpLookupTestCase(unittest.TestCase):
+    """Test database dump lookup."""
+
+    def test_compressed_dump_is_found(self):
+        """Check that compressed and directory dumps are found."""
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        self.assertIsNone(database.find_dump(workdir, "modoboa"))
+        Path(workdir, "modoboa.sql.zst").touch()
+        os.mkdir(os.path.join(workdir, "amavis.dump"))
+        path = database.find_dump(workdir, "modoboa")
+        self.assertEqual(path, os.path.join(workdir, "modoboa.sql.zst"))
+        self.assertEqual(database.get_decompress_command(path), "zstd -q -dc")
+        self.assertTrue(
+            os.path.isdir(database.find_dump(workdir, "amavis")))
+
+
+class DatabaseBatchTestCase(unittest.TestCase):
+    """Test query batching."""
+
+    @patch("modoboa_installer.utils.exec_cmd")
+    def test_queries_share_one_session(self, mock_exec_cmd):
+        """Check that queued queries are sent through one client."""
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "database": {"engine": "mysql", "host": "127.0.0.1"},
+            "mysql": {"user": "root", "password": "secret",
+                      "charset": "utf8", "collation": "utf8_general_ci"},
+        })
+        backend = database.MySQL(config)
+        with backend.batch():
+            backend.create_user("modoboa", "password")
+            backend.create_database("modoboa", "modoboa")
+            mock_exec_cmd.assert_not_called()
+        self.assertEqual(mock_exec_cmd.call_count, 1)
+        cmd = mock_exec_cmd.call_args[0][0]
+        self.assertTrue(cmd.startswith("mysql --force"))
+        self.assertEqual(cmd.count("CREATE USER"), 2)
+        self.assertEqual(cmd.count("GRANT ALL"), 2)
+
+
+class TuningTestCase(unittest.TestCase):
+    """Test sizing of services."""
+
+    def test_uwsgi_topology(self):
+        """Check that uWSGI settings follow host resources."""
+        config = configparser.ConfigParser()
+        config.read_dict({"uwsgi": {
+            "nb_processes": "auto", "nb_threads": "auto",
+            "expected_concurrency": "64", "harakiri": "auto"}})
+        gib = 1024 * tuning.MEBIBYTE
+        topology = tuning.get_uwsgi_topology(
+            config, cpus=4, memory=4 * gib, somaxconn=128)
+        self.assertEqual(topology["processes"], 8)
+        self.assertEqual(topology["threads"], 8)
+        self.assertEqual(topology["listen"], 128)
+        self.assertEqual(topology["harakiri"], 120)
+        self.assertLess(topology["cheaper"], topology["processes"])
+        # Small host: memory limits processes
+        topology = tuning.get_uwsgi_topology(
+            config, cpus=8, memory=1 * gib, somaxconn=4096)
+        self.assertEqual(topology["processes"], 2)
+        self.assertEqual(topology["cheaper"], 0)
+        config.set("uwsgi", "nb_processes", "4")
+        topology = tuning.get_uwsgi_topology(
+            config, cpus=8, memory=1 * gib, somaxconn=4096)
+        self.assertEqual(topology["processes"], 4)
+
+    def test_explicit_values(self):
+        """Check that explicit values are used or rejected, not replaced."""
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "uwsgi": {"harakiri": "0"},
+            "rspamd": {"worker_count": "0"},
+        })
+        topology = tuning.get_uwsgi_topology(
+            config, cpus=2, memory=2048 * tuning.MEBIBYTE, somaxconn=128)
+        self.assertEqual(topology["harakiri"], 0)
+        with self.assertRaises(utils.FatalError):
+            tuning.get_rspamd_settings(config, cpus=2)
+        config.set("rspamd", "worker_count", "two")
+        with self.assertRaises(utils.FatalError):
+            tuning.get_rspamd_settings(config, cpus=2)
+
+    def test_postfix_profile(self):
+        """Check postfix profile selection."""
+        config = configparser.ConfigParser()
+        config.read_dict({"postfix": {"profile": "auto"}})
+        gib = 1024 * tuning.MEBIBYTE
+        self.assertEqual(
+            tuning.get_postfix_profile(config, cpus=1, memory=4 * gib),
+            "small")
+        self.assertEqual(
+            tuning.get_postfix_profile(config, cpus=16, memory=32 * gib),
+            "high-volume")
+        config.set("postfix", "profile", "medium")
+        settings = tuning.get_postfix_settings(config, cpus=1, memory=gib)
+        self.assertEqual(settings["profile"], "medium")
+        config.set("postfix", "profile", "huge")
+        with self.assertRaises(utils.FatalError):
+            tuning.get_postfix_settings(config)
+
+    def test_postgres_connections(self):
+        """Check that max_connections covers enabled components."""
+        config = utils.load_config_template(False)
+        config.set("uwsgi", "nb_processes", "10")
+        config.set("uwsgi", "nb_threads", "4")
+        config.set("postfix", "profile", "high-volume")
+        config.set("amavis", "enabled", "true")
+        config.set("amavis", "max_servers", "20")
+        for section in ["dovecot", "opendkim"]:
+            config.set(section, "enabled", "false")
+        demand = tuning.get_connection_demand(config)
+        self.assertEqual(
+            demand,
+            40 + tuning.MODOBOA_BACKGROUND_CONNECTIONS +
+            16 * tuning.POSTFIX_SQL_MAPS + 20)
+        settings = tuning.get_postgres_settings(
+            config, cpus=4, memory=8192 * tuning.MEBIBYTE)
+        self.assertGreaterEqual(settings["max_connections"], demand)
+        self.assertEqual(settings["shared_buffers"], "1024MB")
+        self.assertIn("max_parallel_maintenance_workers", settings)
+        # PostgreSQL 10 refuses to start with unknown settings
+        settings = tuning.get_postgres_settings(
+            config, cpus=4, memory=8192 * tuning.MEBIBYTE, version=10)
+        self.assertIn("max_parallel_workers", settings)
+        self.assertNotIn("max_parallel_maintenance_workers", settings)
+
+    def test_amavis_plan(self):
+        """Check that postfix, amavis and clamd limits are consistent."""
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "amavis": {"max_servers": "auto"},
+            "postfix": {"profile": "auto"},
+        })
+        plan = tuning.get_amavis_plan(
+            config, cpus=4, memory=8192 * tuning.MEBIBYTE)
+        self.assertEqual(plan["max_servers"], 8)
+        self.assertEqual(plan["smtpd_maxproc"], 100)
+        self.assertEqual(plan["clamd_max_threads"], 8)
+        plan["clamd_max_threads"] = 4
+        with self.assertRaises(utils.FatalError):
+            tuning.validate_amavis_plan(plan)
+        # Postfix process limits are never lowered by amavis
+        plan = tuning.get_amavis_plan(
+            config, cpus=1, memory=1024 * tuning.MEBIBYTE)
+        self.assertEqual(plan["smtpd_maxproc"], 50)
+
+    def test_clamav_settings(self):
+        """Check clamd limits and database reload mode."""
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "postfix": {"message_size_limit": "11534336"},
+            "clamav": {"max_threads": "auto", "max_file_size": "auto",
+                       "max_scan_size": "auto", "database_reload": "auto"},
+        })
+        settings = tuning.get_clamav_settings(
+            config, cpus=1, memory=2048 * tuning.MEBIBYTE)
+        self.assertEqual(settings["MaxThreads"], 4)
+        self.assertEqual(settings["MaxFileSize"], "16M")
+        self.assertEqual(settings["MaxScanSize"], "64M")
+        self.assertEqual(settings["ConcurrentDatabaseReload"], "no")
+        config.set("clamav", "database_reload", "concurrent")
+        settings = tuning.get_clamav_settings(
+            config, cpus=1, memory=2048 * tuning.MEBIBYTE)
+        self.assertEqual(settings["ConcurrentDatabaseReload"], "yes")
+        config.set("clamav", "database_reload", "fast")
+        with self.assertRaises(utils.FatalError):
+            tuning.get_clamav_settings(config, cpus=1, memory=0)
+
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_missing_clamd_config(self, mock_stdout):
+        """Check that a missing clamd configuration file is skipped."""
+        config = utils.load_config_template(False)
+        clamav = scripts.load_app_script("clamav").Clamav(
+            config, False, None)
+        with patch.object(clamav, "get_clamd_config_path",
+                          return_value="/nonexistent/clamd.conf"):
+            clamav.update_clamd_config()
+        self.assertFalse(clamav.config_changed)
+        self.assertIn("not found", mock_stdout.getvalue())
+
+
+class DatabasePoolerTestCase(unittest.TestCase):
+    """Test connections through PgBouncer."""
+
+    def test_pooled_applications(self):
+        """Check that only pooled applications use PgBouncer."""
+        config = utils.load_config_template(False)
+        config.set("database", "host", "10.0.0.5")
+        config.set("pgbouncer", "enabled", "true")
+        config.set("opendkim", "enabled", "false")
+        for section in ["modoboa", "amavis", "spamassassin"]:
+            config.set(section, "dbpassword", "secret")
+        amavis = scripts.load_app_script("amavis").Amavis(
+            config, False, None)
+        self.assertEqual((amavis.dbhost, amavis.dbport), ("127.0.0.1", "6432"))
+        self.assertEqual(amavis.get_dbi_driver(), "Pg(pg_server_prepare=>0)")
+        pgbouncer = scripts.load_app_script("pgbouncer").Pgbouncer(
+            config, False, None)
+        self.assertEqual(pgbouncer.dbhost, "10.0.0.5")
+        self.assertEqual(
+            pgbouncer.get_users(), {
+                "amavis": "secret", "modoboa": "secret",
+                "spamassassin": "secret"})
+        config.set("database", "engine", "mysql")
+        self.assertFalse(database.is_pooler_enabled(config))
+
+
 if __name__ == "__main__":
     unittest.main()